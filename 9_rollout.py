@@ -1,7 +1,17 @@
-from flask import Flask, request, make_response, render_template_string, jsonify
+from flask import Flask, request, make_response, jsonify, Response
+from markupsafe import Markup
+import os
+import json
 import uuid
 import hashlib
-from datetime import datetime
+import threading
+from datetime import datetime, timezone
+import assignment
+import stores
+import eventlog
+import aggregates
+import analysis
+import monitor
 
 app = Flask(__name__)
 
@@ -27,23 +37,48 @@ INDEX_TEMPLATE = """
             return await res.json();
         }
 
-        async function sendEvent(eventName, params = {}) {
+        const EVENTS_FLUSH_MS = 2000;
+        const EVENTS_MAX_BUFFER = 20;
+        let eventsBuffer = [];
+
+        function sendEvent(eventName, params = {}) {
             let ts = new Date().toISOString();
-            await fetch('/events', {
+            eventsBuffer.push({
+                ts: ts,
+                deviceId: deviceId,
+                source: 'browser',
+                event: eventName,
+                params: params
+            });
+            if (eventsBuffer.length >= EVENTS_MAX_BUFFER) {
+                flushEvents();
+            }
+        }
+
+        function flushEvents(useBeacon = false) {
+            if (eventsBuffer.length === 0) return Promise.resolve();
+            const body = JSON.stringify(eventsBuffer);
+            eventsBuffer = [];
+            if (useBeacon && navigator.sendBeacon) {
+                navigator.sendBeacon('/events/bulk', new Blob([body], { type: 'application/json' }));
+                return Promise.resolve();
+            }
+            return fetch('/events/bulk', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({
-                    ts: ts,
-                    deviceId: deviceId,
-                    source: 'browser',
-                    event: eventName,
-                    params: params
-                })
+                body: body,
+                keepalive: true
             });
         }
 
+        setInterval(flushEvents, EVENTS_FLUSH_MS);
+        document.addEventListener('visibilitychange', () => {
+            if (document.visibilityState === 'hidden') flushEvents(true);
+        });
+        window.addEventListener('pagehide', () => flushEvents(true));
+
         async function renderPage() {
-            const experiments = await getExpGroups(deviceId);
+            const experiments = BOOTSTRAP_GROUPS || await getExpGroups(deviceId);
             let exp = experiments["moon_mars"];
             let moon_mars_group = exp.group;
             exp = experiments["white_gold_btn"];
@@ -71,6 +106,7 @@ INDEX_TEMPLATE = """
             }
         }
 
+        const BOOTSTRAP_GROUPS = {{ bootstrap }};
         const deviceId = getCookie("device_id");
         sendEvent("pageview", {});
         renderPage();
@@ -79,25 +115,153 @@ INDEX_TEMPLATE = """
 </html>
 """
 
+# Templates are compiled once; the pages only depend on url_for('static'),
+# so the rendered HTML is cached per script root and revalidated with ETag/Last-Modified.
+# With INDEX_BOOTSTRAP the index page inlines the device's groups as JSON at BOOTSTRAP_MARKER
+# instead of fetching /api/expgroups, and the page varies per device.
+INDEX_PAGE = app.jinja_env.from_string(INDEX_TEMPLATE)
+INDEX_BOOTSTRAP = os.environ.get("INDEX_BOOTSTRAP", "1") != "0"
+BOOTSTRAP_MARKER = "__BOOTSTRAP_GROUPS__"
+PAGE_CACHE = {}
+
+def render_page(template, bootstrap: dict = None) -> Response:
+    key = (id(template), request.script_root, app.static_url_path)
+    page = PAGE_CACHE.get(key)
+    if page is None:
+        html = template.render(bootstrap=Markup(BOOTSTRAP_MARKER))
+        etag = hashlib.blake2b(html.encode(), digest_size=16).hexdigest()
+        page = PAGE_CACHE[key] = (html.split(BOOTSTRAP_MARKER), etag, datetime.now(timezone.utc).replace(microsecond=0))
+    parts, etag, last_modified = page
+    if bootstrap is None:
+        response = make_response("null".join(parts))
+        response.last_modified = last_modified
+    else:
+        data = json.dumps(bootstrap).replace("<", "\\u003c")
+        response = make_response(data.join(parts))
+        etag += "-" + hashlib.blake2b(data.encode(), digest_size=8).hexdigest()
+        response.vary.add("Cookie")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @app.route('/')
 def index():
     device_id = request.cookies.get("device_id")
     if not device_id:
         device_id = str(uuid.uuid4())
-    response = make_response(render_template_string(INDEX_TEMPLATE))
+    if INDEX_BOOTSTRAP:
+        result, token = exp_groups(device_id, request.cookies.get(TOKEN_COOKIE))
+        response = render_page(INDEX_PAGE, result)
+        set_token_cookie(response, token)
+    else:
+        response = render_page(INDEX_PAGE)
     response.set_cookie("device_id", device_id, max_age=60*60*24*365)
     return response
 
-EVENTS = []
+EVENTS = eventlog.EventStore(os.environ.get("EVENTS_DIR", "events"))
+AGGREGATES = aggregates.ExperimentAggregates()
+UNIQUES = aggregates.UniqueDevices(AGGREGATES.device_groups)
+INGEST = eventlog.IngestQueue(EVENTS, policy=os.environ.get("EVENTS_BACKPRESSURE", "drop"))
+INGEST.listeners.append(AGGREGATES.extend)
+INGEST.listeners.append(UNIQUES.extend)
+INGEST.replay()
+INGEST.start()
+EVENTS_PAGE_SIZE = 1000
+EVENTS_MAX_PAGE_SIZE = 10000
+EVENTS_MAX_BULK = 1000
 
 @app.route('/events', methods=['GET', 'POST'])
 def events():
     if request.method == 'POST':
-        data = request.json
-        EVENTS.append(data)
+        data = request.get_json(silent=True)
+        error = eventlog.event_error(data)
+        if error:
+            return jsonify({"error": error}), 400
+        if not ingest_event(data):
+            return jsonify({"status": "dropped"}), 503
         return jsonify({"status": "ok"})
     else:
-        return jsonify(EVENTS)
+        return events_query()
+
+@app.route('/events/bulk', methods=['POST'])
+def events_bulk():
+    body = request.get_data(as_text=True)
+    try:
+        data = json.loads(body)
+    except ValueError:
+        lines = [line for line in body.splitlines() if line.strip()]
+        if len(lines) > EVENTS_MAX_BULK:
+            return jsonify({"error": f"At most {EVENTS_MAX_BULK} events per request"}), 413
+        try:
+            data = [json.loads(line) for line in lines]
+        except ValueError:
+            return jsonify({"error": "Body must be a JSON array or NDJSON"}), 400
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        return jsonify({"error": "Events must be JSON objects"}), 400
+    if len(data) > EVENTS_MAX_BULK:
+        return jsonify({"error": f"At most {EVENTS_MAX_BULK} events per request"}), 413
+    for i, e in enumerate(data):
+        error = eventlog.event_error(e)
+        if error:
+            return jsonify({"error": f"Event {i}: {error}"}), 400
+    accepted = sum(ingest_event(e) for e in data)
+    return jsonify({"status": "ok", "accepted": accepted, "dropped": len(data) - accepted})
+
+def ingest_event(event: dict) -> bool:
+    return INGEST.put(event)
+
+def window_error(since, until):
+    for t, value in (("since", since), ("until", until)):
+        if value is not None:
+            try:
+                datetime.fromisoformat(value.replace("Z", "+00:00"))
+            except ValueError:
+                return f"Invalid '{t}': must be an ISO timestamp"
+    return None
+
+def events_query():
+    filters = {
+        "event": request.args.get("event"),
+        "device_id": request.args.get("deviceId"),
+        "source": request.args.get("source"),
+        "since": request.args.get("since"),
+        "until": request.args.get("until")
+    }
+    error = window_error(filters["since"], filters["until"])
+    if error:
+        return jsonify({"error": error}), 400
+    cursor = request.args.get("cursor")
+    INGEST.flush()
+    try:
+        eventlog.parse_cursor(cursor)
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+    limit = request.args.get("limit")
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            return jsonify({"error": "Invalid 'limit': must be an integer"}), 400
+    if request.args.get("format") == "ndjson":
+        def stream():
+            for _, e in EVENTS.scan(cursor, **filters):
+                if e is not None:
+                    yield json.dumps(e) + "\n"
+        return Response(stream(), mimetype="application/x-ndjson")
+    if limit is None and cursor is None:
+        return jsonify([e for _, e in EVENTS.scan(**filters) if e is not None])
+    limit = min(max(limit or EVENTS_PAGE_SIZE, 1), EVENTS_MAX_PAGE_SIZE)
+    page = []
+    next_cursor = cursor
+    for next_cursor, e in EVENTS.scan(cursor, **filters):
+        if e is None:
+            break
+        page.append(e)
+        if len(page) == limit:
+            break
+    return jsonify({"events": page, "next_cursor": next_cursor, "has_more": len(page) == limit})
 
 EXPERIMENTS = {
     "moon_mars": {
@@ -120,7 +284,31 @@ EXPERIMENTS = {
     }
 }
 
-ASSIGNEDGROUPS = {}
+CONFIG = assignment.compile_config(assignment.compile_experiments(EXPERIMENTS))
+UPDATE_LOCK = threading.Lock()
+EDITS_MAX = 20
+
+# Signed cookie with the device's groups; while CONFIG.epoch is unchanged
+# / and /api/expgroups answer from it without assign_group and ASSIGNEDGROUPS.
+TOKEN_COOKIE = "exp_token"
+TOKEN_SECRET = os.environ.get("ASSIGNMENT_TOKEN_SECRET", "").encode() or os.urandom(32)
+
+# exp_groups events are logged when a device's groups change or once per EXPOSURE_WINDOW seconds;
+# EXPOSURE_WINDOW=0 logs every call.
+EXPOSURES = stores.ExposureFilter(window=float(os.environ.get("EXPOSURE_WINDOW", 86400)))
+
+def active_weights() -> dict:
+    return {name: assignment.expected_weights(exp) for name, exp in CONFIG.experiments.items() if exp.state == "active"}
+
+MONITOR = monitor.SplitMonitor(AGGREGATES, active_weights,
+                               interval=float(os.environ.get("MONITOR_INTERVAL", 60)))
+MONITOR.start()
+
+ASSIGNEDGROUPS_DB = os.environ.get("ASSIGNEDGROUPS_DB")
+if ASSIGNEDGROUPS_DB:
+    ASSIGNEDGROUPS = stores.SQLiteStickyStore(ASSIGNEDGROUPS_DB)
+else:
+    ASSIGNEDGROUPS = stores.StickyStore()
 
 EXPERIMENTS_TEMPLATE = """
 <!DOCTYPE html>
@@ -147,6 +335,7 @@ EXPERIMENTS_TEMPLATE = """
                     <th>Experiment</th>
                     <th>Key</th>
                     <th>Group: Weight</th>
+                    <th>Exposed</th>
                     <th>Fallback</th>
                     <th>State</th>
                     <th>Rollout</th>
@@ -167,6 +356,7 @@ EXPERIMENTS_TEMPLATE = """
                     groups += `<div class="group-weight">${escapeHTML(g)}: ${w}</div>`;
                 }
                 row.innerHTML += `<td>${groups}</td>`;
+                row.innerHTML += `<td class="uniques" data-exp="${escapeHTML(name)}"></td>`;
                 row.innerHTML += `<td>${escapeHTML(exp.fallback)}</td>`;
                 row.innerHTML += `<td>${exp.state}</td>`;
                 let rollout_group = exp.rollout_group ? escapeHTML(exp.rollout_group) : '';
@@ -192,6 +382,7 @@ EXPERIMENTS_TEMPLATE = """
                     </div>`;
                 }
                 editRow.innerHTML += `<td>${groups}</td>`;
+                editRow.innerHTML += `<td></td>`;
                 editRow.innerHTML += `<td>${escapeHTML(exp.fallback)}</td>`;
                 let stateSelect = `<select class="stateselect" onchange="onStateChange('${editRow.id}')">`;
                 if (exp.state === "inactive") {
@@ -302,34 +493,153 @@ EXPERIMENTS_TEMPLATE = """
             return `${year}-${month}-${day} ${hours}:${minutes}`;
         }
 
-        fetchExperiments().then(renderExperiments);
+        async function renderUniques() {
+            for (const cell of document.querySelectorAll('td.uniques')) {
+                const res = await fetch(`/api/experiments/${encodeURIComponent(cell.dataset.exp)}/uniques`);
+                const uniques = await res.json();
+                let groups = "";
+                for (const [g, n] of Object.entries(uniques.groups || {})) {
+                    groups += `<div class="group-weight">${escapeHTML(g)}: ~${n}</div>`;
+                }
+                cell.innerHTML = groups;
+            }
+        }
+
+        fetchExperiments().then(renderExperiments).then(renderUniques);
     </script>
 </body>
 </html>
 """
 
+EXPERIMENTS_PAGE = app.jinja_env.from_string(EXPERIMENTS_TEMPLATE)
+
 @app.route('/experiments', methods=['GET'])
 def experiments_page():
-    return render_template_string(EXPERIMENTS_TEMPLATE, experiments=EXPERIMENTS)
+    return render_page(EXPERIMENTS_PAGE)
 
 @app.route('/api/experiments')
 def api_experiments():
     return jsonify(EXPERIMENTS)
 
+@app.route('/api/experiments/<name>/stats')
+def api_experiment_stats(name):
+    if name not in EXPERIMENTS:
+        return jsonify({"error": "Experiment not found"}), 404
+    return jsonify(AGGREGATES.stats(name))
+
+@app.route('/api/experiments/<name>/report')
+def api_experiment_report(name):
+    if name not in CONFIG.experiments:
+        return jsonify({"error": "Experiment not found"}), 404
+    return jsonify(analysis.report({name: report_input(name)})[name])
+
+def report_input(name: str) -> dict:
+    exp = CONFIG.experiments[name]
+    stats = AGGREGATES.stats(name)["groups"]
+    groups = list(exp.names) + sorted(g for g in stats if g not in exp.names)
+    weights = assignment.expected_weights(exp)
+    empty = {"pageviews": 0, "clicks": 0, "devices": 0}
+    return {
+        "control": exp.fallback,
+        "groups": groups,
+        "visits": [stats.get(g, empty)["pageviews"] for g in groups],
+        "clicks": [stats.get(g, empty)["clicks"] for g in groups],
+        "devices": [stats.get(g, empty)["devices"] for g in groups],
+        "weights": [weights.get(g, 0) for g in groups]
+    }
+
+@app.route('/api/experiments/<name>/uniques')
+def api_experiment_uniques(name):
+    if name not in EXPERIMENTS:
+        return jsonify({"error": "Experiment not found"}), 404
+    event = request.args.get("event", "exp_groups")
+    since, until = request.args.get("since"), request.args.get("until")
+    error = window_error(since, until)
+    if error:
+        return jsonify({"error": error}), 400
+    return jsonify({"experiment": name,
+                    "event": event,
+                    "groups": UNIQUES.estimate(name, event, since, until)})
+
+@app.route('/api/monitor/alerts')
+def api_monitor_alerts():
+    if request.args.get("refresh"):
+        return jsonify(MONITOR.check())
+    return jsonify(MONITOR.status())
+
 @app.route('/api/expgroups')
 def api_expgroups():
+    # The ETag is the version of the device's groups; a client sending it back as
+    # If-None-Match or ?version= gets an empty 304 while nothing changed.
     device_id = request.args.get("device_id")
+    result, token = exp_groups(device_id, request.cookies.get(TOKEN_COOKIE))
+    version = f"{groups_digest(result):016x}"
+    if request.args.get("version") == version:
+        response = Response(status=304)
+    else:
+        response = jsonify(result)
+    response.set_etag(version)
+    response.cache_control.no_cache = True
+    response.cache_control.private = True
+    set_token_cookie(response, token)
+    return response.make_conditional(request)
+
+def groups_digest(result: dict) -> int:
+    key = json.dumps(result, sort_keys=True, separators=(",", ":")).encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big')
+
+def exp_groups(device_id: str, token: str = None) -> tuple:
+    # Groups of a device in all experiments, logged as one exp_groups exposure,
+    # and a new token when the given one is not valid for the current config.
+    config = CONFIG
+    compiled = config.experiments
+    new_token = None
+    if not device_id:
+        groups = {exp_name: "" for exp_name in compiled}
+    else:
+        groups = assignment.read_token(TOKEN_SECRET, token, device_id, config.epoch, compiled)
+    if groups is None:
+        # One hash per layer, shared by all experiments in it.
+        buckets = {name: assignment.layer_bucket(device_id, name, layer.hash)
+                   for name, layer in config.layers.items()}
+        groups = {exp_name: assign_group(device_id, exp_name, config, buckets.get(exp.layer))
+                  for exp_name, exp in compiled.items()}
+        new_token = assignment.make_token(TOKEN_SECRET, device_id, config.epoch, groups)
     result = {}
-    for exp_name, info in EXPERIMENTS.items():
-        group = assign_group(device_id, exp_name) if device_id else ""
+    for exp_name, exp in compiled.items():
         result[exp_name] = {
-            "state": info["state"],
-            "fallback": info["fallback"],
-            "group": group
+            "state": exp.state,
+            "fallback": exp.fallback,
+            "group": groups[exp_name]
         }
+        if groups[exp_name] is None:
+            # Outside the experiment's layer buckets: shown the fallback, not counted in the experiment.
+            result[exp_name].update(group=exp.fallback, excluded=True)
     if device_id:
-        post_event("exp_groups", device_id, result)
-    return jsonify(result)
+        digest = groups_digest(result)
+        if EXPOSURES.should_log(device_id, digest) and post_event("exp_groups", device_id, result):
+            EXPOSURES.record(device_id, digest)
+    return result, new_token
+
+def set_token_cookie(response: Response, token: str):
+    if token:
+        response.set_cookie(TOKEN_COOKIE, token, max_age=60*60*24*365, httponly=True, samesite="Lax")
+
+@app.route('/api/expgroups/batch', methods=['POST'])
+def api_expgroups_batch():
+    data = request.json or {}
+    device_ids = data.get("device_ids")
+    if not isinstance(device_ids, list) or not all(isinstance(d, str) and d for d in device_ids):
+        return jsonify({"error": "device_ids must be a list of non-empty strings"}), 400
+    config = CONFIG
+    result = {}
+    for exp_name, exp in config.experiments.items():
+        result[exp_name] = {
+            "state": exp.state,
+            "fallback": exp.fallback,
+            "groups": assign_groups_batch(device_ids, exp_name, config)
+        }
+    return jsonify({"device_ids": device_ids, "experiments": result})
 
 @app.route('/api/experiments/update', methods=['POST'])
 def update_experiment():
@@ -337,77 +647,131 @@ def update_experiment():
     name = data.get("name")
     if not name or name not in EXPERIMENTS:
         return jsonify({"error": "Experiment not found"}), 404
-    current_state = EXPERIMENTS[name]["state"]
-    new_state = data.get("state", current_state)
-    allowed_transitions = [("inactive", "inactive"),
-                           ("inactive", "active"),
-                           ("active", "inactive"),
-                           ("active", "active"),
-                           ("active", "rollout"),
-                           ("rollout", "rollout"),
-                           ("rollout", "active")]
-    if not (current_state, new_state) in allowed_transitions:
-        return jsonify({"error": f"Can't change state from {current_state} to {new_state}"}), 400
-    rollout_group = data.get("rollout_group")
-    if new_state == "rollout" and rollout_group not in EXPERIMENTS[name]["groups"]:
-        return jsonify({"error": "Invalid rollout group"}), 400
-    EXPERIMENTS[name]["state"] = new_state
-    if current_state == "inactive" and new_state == "active":
-        EXPERIMENTS[name]["start"] = datetime.now().isoformat()
-        EXPERIMENTS[name]["end"] = None
-    elif current_state == "active" and new_state == "inactive":
-        EXPERIMENTS[name]["end"] = datetime.now().isoformat()
-    elif current_state == "active" and new_state == "rollout":
-        EXPERIMENTS[name]["rollout_group"] = rollout_group
-        EXPERIMENTS[name]["end"] = datetime.now().isoformat()
-    elif current_state == "rollout" and new_state == "rollout":
-        EXPERIMENTS[name]["rollout_group"] = rollout_group
-    elif current_state == "rollout" and new_state == "active":
-        EXPERIMENTS[name]["rollout_group"] = None
-        EXPERIMENTS[name]["start"] = datetime.now().isoformat()
-        EXPERIMENTS[name]["end"] = None
-    if new_state != "rollout":
-        old_groups = set(EXPERIMENTS[name]["groups"].keys())
-        new_groups = set(data.get("groups", {}).keys())
-        if old_groups != new_groups:
-            jsonify({"error": f"Can't change {name} group weights"}), 400
-        for g, w in data["groups"].items():
-            try:
-                w_int = int(w)
-            except Exception as e:
-                return jsonify({"error": f"Invalid weight for group '{g}': must be an integer"}), 400
-            if w_int <= 0:
-                return jsonify({"error": f"Invalid weight for group '{g}': must be > 0"}), 400
-            data["groups"][g] = w_int
-        for g in old_groups:
-            EXPERIMENTS[name]["groups"][g] = data["groups"][g]
-    return jsonify({"success": True, "experiment": EXPERIMENTS[name]})
-
-def assign_group(device_id: str, experiment: str) -> str:
-    if EXPERIMENTS[experiment]["state"] == "rollout":
-        return EXPERIMENTS[experiment]["rollout_group"]
-    elif EXPERIMENTS[experiment]["state"] == "inactive":
-        return EXPERIMENTS[experiment]["fallback"]
-    if (device_id, experiment) in ASSIGNEDGROUPS:
-        gr, ts = ASSIGNEDGROUPS[(device_id, experiment)]
+    with UPDATE_LOCK:
+        current_state = EXPERIMENTS[name]["state"]
+        new_state = data.get("state", current_state)
+        allowed_transitions = [("inactive", "inactive"),
+                               ("inactive", "active"),
+                               ("active", "inactive"),
+                               ("active", "active"),
+                               ("active", "rollout"),
+                               ("rollout", "rollout"),
+                               ("rollout", "active")]
+        if not (current_state, new_state) in allowed_transitions:
+            return jsonify({"error": f"Can't change state from {current_state} to {new_state}"}), 400
+        rollout_group = data.get("rollout_group")
+        if new_state == "rollout" and rollout_group not in EXPERIMENTS[name]["groups"]:
+            return jsonify({"error": "Invalid rollout group"}), 400
+        new_weights = {}
+        if new_state != "rollout":
+            old_groups = set(EXPERIMENTS[name]["groups"].keys())
+            new_groups = set(data.get("groups", {}).keys())
+            if old_groups != new_groups:
+                return jsonify({"error": f"Can't change {name} group weights"}), 400
+            for g, w in data["groups"].items():
+                try:
+                    w_int = int(w)
+                except Exception as e:
+                    return jsonify({"error": f"Invalid weight for group '{g}': must be an integer"}), 400
+                if w_int <= 0:
+                    return jsonify({"error": f"Invalid weight for group '{g}': must be > 0"}), 400
+                new_weights[g] = w_int
+        EXPERIMENTS[name]["state"] = new_state
+        if current_state == "inactive" and new_state == "active":
+            EXPERIMENTS[name]["start"] = datetime.now().isoformat()
+            EXPERIMENTS[name]["end"] = None
+        elif current_state == "active" and new_state == "inactive":
+            EXPERIMENTS[name]["end"] = datetime.now().isoformat()
+        elif current_state == "active" and new_state == "rollout":
+            EXPERIMENTS[name]["rollout_group"] = rollout_group
+            EXPERIMENTS[name]["end"] = datetime.now().isoformat()
+        elif current_state == "rollout" and new_state == "rollout":
+            EXPERIMENTS[name]["rollout_group"] = rollout_group
+        elif current_state == "rollout" and new_state == "active":
+            EXPERIMENTS[name]["rollout_group"] = None
+            EXPERIMENTS[name]["start"] = datetime.now().isoformat()
+            EXPERIMENTS[name]["end"] = None
+        EXPERIMENTS[name]["groups"].update(new_weights)
+        old = CONFIG.experiments[name]
+        if old.table and new_weights:
+            table = assignment.allocate_buckets(EXPERIMENTS[name]["groups"], old.total, list(old.table))
+            EXPERIMENTS[name]["bucket_groups"] = assignment.encode_runs(table)
+        edit = None
+        if recompile_experiment(name):
+            edit = edit_report(name, old, CONFIG.experiments[name])
+            edits = EXPERIMENTS[name].setdefault("edits", [])
+            edits.append(edit)
+            del edits[:-EDITS_MAX]
+    return jsonify({"success": True, "experiment": EXPERIMENTS[name], "moved": edit})
+
+def edit_report(name: str, old: assignment.CompiledExperiment, new: assignment.CompiledExperiment) -> dict:
+    # Devices whose hashed group changes with an edit, estimated from the devices seen so far.
+    # Without stable allocation ASSIGNEDGROUPS keeps assigned devices in their old groups.
+    fraction = assignment.moved_fraction(old, new)
+    devices = sum(g["devices"] for g in AGGREGATES.stats(name)["groups"].values())
+    return {
+        "ts": datetime.now().isoformat(),
+        "moved_fraction": fraction,
+        "moved_devices": round(fraction * devices),
+        "devices": devices,
+        "sticky": not new.table
+    }
+
+def recompile_experiment(name: str) -> bool:
+    # Requests read CONFIG once, so they see either the old or the new config, never a mix.
+    global CONFIG
+    compiled = assignment.compile_experiment(EXPERIMENTS[name])
+    if CONFIG.experiments.get(name) == compiled:
+        return False
+    CONFIG = assignment.compile_config({**CONFIG.experiments, name: compiled})
+    return True
+
+def assign_group(device_id: str, experiment: str, config: assignment.CompiledConfig = None,
+                 bucket: int = None) -> str:
+    # None when the device's layer bucket belongs to no group of a layered experiment.
+    config = config or CONFIG
+    exp = config.experiments[experiment]
+    if exp.state == "rollout":
+        return exp.rollout_group
+    elif exp.state == "inactive":
+        return exp.fallback
+    # Stable allocations keep hashed groups across weight changes and skip the sticky store.
+    gr = ASSIGNEDGROUPS.get(device_id, experiment) if not exp.table else None
+    if gr is not None:
         return gr
-    groups = EXPERIMENTS[experiment]["groups"]
-    total_parts = sum(groups.values())
-    key = f"{device_id}:{experiment}"
-    hash_bytes = hashlib.sha256(key.encode()).digest()
-    hash_int = int.from_bytes(hash_bytes, 'big')
-    hash_mod = hash_int % total_parts
-    c = 0
-    chosen = EXPERIMENTS[experiment]["fallback"]
-    for group_name, weight in sorted(groups.items()):
-        c += weight
-        if hash_mod < c:
-            chosen = group_name
-            break
-    ASSIGNEDGROUPS[(device_id, experiment)] = (chosen, datetime.now().isoformat())
+    if exp.layer is not None:
+        layer = config.layers[exp.layer]
+        if bucket is None:
+            bucket = assignment.layer_bucket(device_id, exp.layer, layer.hash)
+        slot = layer.slots[bucket]
+        if slot is None or slot[0] != experiment:
+            return None
+        chosen = slot[1]
+    else:
+        hash_mod = assignment.hash_mod(device_id, experiment, exp.total, exp.hash)
+        chosen = assignment.pick_group(exp, hash_mod)
+    if not exp.table:
+        ASSIGNEDGROUPS.put(device_id, experiment, chosen)
+    return chosen
+
+def assign_groups_batch(device_ids: list, experiment: str, config: assignment.CompiledConfig = None) -> list:
+    exp = (config or CONFIG).experiments[experiment]
+    if exp.state == "rollout":
+        return [exp.rollout_group] * len(device_ids)
+    elif exp.state == "inactive":
+        return [exp.fallback] * len(device_ids)
+    chosen = assignment.batch_assign(device_ids, experiment, exp)
+    if exp.table:
+        return chosen
+    for i, device_id in enumerate(device_ids):
+        gr = ASSIGNEDGROUPS.get(device_id, experiment)
+        if gr is not None:
+            chosen[i] = gr
+        elif chosen[i] is not None:
+            ASSIGNEDGROUPS.put(device_id, experiment, chosen[i])
     return chosen
 
-def post_event(event_name: str, device_id: str, params: dict):
+def post_event(event_name: str, device_id: str, params: dict) -> bool:
     payload = {
         "ts": datetime.utcnow().isoformat(),
         "deviceId": device_id,
@@ -415,8 +779,7 @@ def post_event(event_name: str, device_id: str, params: dict):
         "event": event_name,
         "params": params
     }
-    with app.test_request_context("/events", method="POST", json=payload):
-        return events()
+    return ingest_event(payload)
 
 if __name__ == '__main__':
     app.run(debug=True)
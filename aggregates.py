@@ -0,0 +1,185 @@
+import time
+import threading
+from collections import defaultdict
+import hll
+import eventlog
+
+EXPOSURES, DEVICES, PAGEVIEWS, CLICKS = range(4)
+
+def exposed_groups(e: dict, active_only: bool = False) -> dict:
+    # {experiment: group} of an exp_groups event, skipping malformed and excluded entries;
+    # active_only also skips inactive and rollout entries, where every device sees one group.
+    params = e.get("params")
+    if not isinstance(params, dict):
+        return {}
+    return {exp_name: info["group"] for exp_name, info in params.items()
+            if isinstance(info, dict) and isinstance(info.get("group"), str) and not info.get("excluded")
+            and (not active_only or info.get("state") == "active")}
+
+def move_pairs(pairs, groups: dict, exp_name: str, old, group: str):
+    # Moves a device from old to group in its pair cells with the other experiments in groups.
+    for other, other_group in groups.items():
+        if other == exp_name:
+            continue
+        if exp_name < other:
+            table, cell, old_cell = pairs[(exp_name, other)], (group, other_group), (old, other_group)
+        else:
+            table, cell, old_cell = pairs[(other, exp_name)], (other_group, group), (other_group, old)
+        if old is not None:
+            table[old_cell] -= 1
+        table[cell] += 1
+
+class ExperimentAggregates:
+    # Per-experiment, per-group counters updated as events arrive.
+    # Every device keeps its pageview and click totals and its latest group in each experiment;
+    # when an exp_groups event moves a device to another group, its totals move with it.
+    # The numbers match a full scan that attributes all events of a device to its last group.
+    # pairs holds devices per (group, group) for every pair of experiments, keyed by sorted names.
+    # active_devices and active_pairs count the same by the latest group seen while each
+    # experiment was active, for the split monitor.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.devices = {}
+        self.groups = defaultdict(lambda: defaultdict(lambda: [0, 0, 0, 0]))
+        self.pairs = defaultdict(lambda: defaultdict(int))
+        self.active_devices = defaultdict(lambda: defaultdict(int))
+        self.active_pairs = defaultdict(lambda: defaultdict(int))
+        self.pageviews = 0
+        self.clicks = 0
+
+    def extend(self, events: list):
+        with self.lock:
+            for e in events:
+                self._add(e)
+
+    def _add(self, e: dict):
+        device_id = e.get("deviceId")
+        if not isinstance(device_id, str):
+            return
+        name = e.get("event")
+        dev = self.devices.get(device_id)
+        if dev is None:
+            dev = self.devices[device_id] = [0, 0, {}, {}]
+        if name == "pageview":
+            dev[0] += 1
+            self.pageviews += 1
+            for exp_name, group in dev[2].items():
+                self.groups[exp_name][group][PAGEVIEWS] += 1
+        elif name == "button_click":
+            dev[1] += 1
+            self.clicks += 1
+            for exp_name, group in dev[2].items():
+                self.groups[exp_name][group][CLICKS] += 1
+        elif name == "exp_groups":
+            for exp_name, group in exposed_groups(e).items():
+                counts = self.groups[exp_name]
+                counts[group][EXPOSURES] += 1
+                old = dev[2].get(exp_name)
+                if old == group:
+                    continue
+                if old is not None:
+                    counts[old][DEVICES] -= 1
+                    counts[old][PAGEVIEWS] -= dev[0]
+                    counts[old][CLICKS] -= dev[1]
+                counts[group][DEVICES] += 1
+                counts[group][PAGEVIEWS] += dev[0]
+                counts[group][CLICKS] += dev[1]
+                move_pairs(self.pairs, dev[2], exp_name, old, group)
+                dev[2][exp_name] = group
+            for exp_name, group in exposed_groups(e, active_only=True).items():
+                old = dev[3].get(exp_name)
+                if old == group:
+                    continue
+                devices = self.active_devices[exp_name]
+                if old is not None:
+                    devices[old] -= 1
+                devices[group] += 1
+                move_pairs(self.active_pairs, dev[3], exp_name, old, group)
+                dev[3][exp_name] = group
+
+    def device_groups(self, device_id: str) -> dict:
+        with self.lock:
+            dev = self.devices.get(device_id)
+            return dict(dev[2]) if dev is not None else {}
+
+    def pair_table(self, exp1: str, exp2: str, active: bool = False) -> dict:
+        pairs = self.active_pairs if active else self.pairs
+        with self.lock:
+            if exp1 < exp2:
+                return {cell: n for cell, n in pairs.get((exp1, exp2), {}).items() if n}
+            return {(g1, g2): n for (g2, g1), n in pairs.get((exp2, exp1), {}).items() if n}
+
+    def active_group_devices(self, exp_name: str) -> dict:
+        with self.lock:
+            return {g: n for g, n in self.active_devices.get(exp_name, {}).items() if n}
+
+    def stats(self, exp_name: str) -> dict:
+        with self.lock:
+            groups = {g: {"exposures": c[EXPOSURES],
+                          "devices": c[DEVICES],
+                          "pageviews": c[PAGEVIEWS],
+                          "clicks": c[CLICKS]}
+                      for g, c in self.groups.get(exp_name, {}).items()}
+            unassigned = {"pageviews": self.pageviews - sum(g["pageviews"] for g in groups.values()),
+                          "clicks": self.clicks - sum(g["clicks"] for g in groups.values())}
+        return {"experiment": exp_name, "groups": groups, "unassigned": unassigned}
+
+HOUR_US = 3600 * 1_000_000
+
+class UniqueDevices:
+    # HyperLogLog sketches of device ids per (hour, experiment, group, event).
+    # exp_groups events carry the group; other events use groups_of(device_id).
+    # Sketches more than max_hours before the server clock are dropped, so memory is bounded by
+    # max_hours * experiments * groups * event types * 2**p bytes. Client timestamps
+    # in the future count as now and never move the horizon.
+
+    def __init__(self, groups_of, p: int = 12, max_hours: int = 24 * 90, clock=time.time):
+        self.groups_of = groups_of
+        self.p = p
+        self.max_hours = max_hours
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.sketches = {}
+
+    def extend(self, events: list):
+        keys = defaultdict(list)
+        now_hour = int(self.clock() * 1_000_000) // HOUR_US
+        oldest = now_hour - self.max_hours
+        for e in events:
+            device_id = e.get("deviceId")
+            if not isinstance(device_id, str):
+                continue
+            hour = min(eventlog.parse_ts(e.get("ts")) // HOUR_US, now_hour)
+            if hour <= oldest:
+                continue
+            name = e.get("event")
+            if name == "exp_groups":
+                groups = exposed_groups(e)
+            else:
+                groups = self.groups_of(device_id)
+            for exp_name, group in groups.items():
+                keys[(hour, exp_name, group, name)].append(device_id)
+        with self.lock:
+            for key, device_ids in keys.items():
+                sketch = self.sketches.get(key)
+                if sketch is None:
+                    sketch = self.sketches[key] = hll.HyperLogLog(self.p)
+                sketch.add(device_ids)
+            for key in [k for k in self.sketches if k[0] <= oldest]:
+                del self.sketches[key]
+
+    def estimate(self, exp_name: str, event: str = "exp_groups", since=None, until=None) -> dict:
+        since_hour = eventlog.parse_ts(since) // HOUR_US if since is not None else None
+        until_hour = eventlog.parse_ts(until) // HOUR_US if until is not None else None
+        merged = {}
+        with self.lock:
+            for (hour, e_name, group, name), sketch in self.sketches.items():
+                if e_name != exp_name or name != event:
+                    continue
+                if since_hour is not None and hour < since_hour:
+                    continue
+                if until_hour is not None and hour > until_hour:
+                    continue
+                merged[group] = merged[group].merge(sketch) if group in merged else sketch
+        return {group: round(sketch.estimate()) for group, sketch in merged.items()}
@@ -0,0 +1,151 @@
+from math import erfc, exp, sqrt, pi
+import numpy as np
+
+Z95 = 1.959963984540054
+SRM_ALPHA = 0.001
+
+_erfc = np.vectorize(erfc, otypes=[float])
+
+def normal_sf(z) -> np.ndarray:
+    return 0.5 * _erfc(np.asarray(z, dtype=float) / sqrt(2))
+
+def chi2_sf(x: float, df: int) -> float:
+    # Closed form of the chi-square survival function for integer degrees of freedom.
+    if df <= 0 or np.isnan(x):
+        return float("nan")
+    if df % 2 == 0:
+        term = total = 1.0
+        for i in range(1, df // 2):
+            term *= (x / 2) / i
+            total += term
+        return float(exp(-x / 2) * total)
+    total = erfc(sqrt(x / 2))
+    if df > 1:
+        term = sqrt(2 * x / pi) * exp(-x / 2)
+        total += term
+        for i in range(2, (df + 1) // 2):
+            term *= x / (2 * i - 1)
+            total += term
+    return float(total)
+
+def chi2_goodness_of_fit(observed: dict, weights: dict, min_expected: float = 5) -> dict:
+    # Observed counts against counts proportional to weights. Returns None
+    # when there are too few observations for the chi-square approximation.
+    keys = sorted(set(observed) | set(weights), key=str)
+    o = np.array([observed.get(k, 0) for k in keys], dtype=float)
+    w = np.array([weights.get(k, 0) for k in keys], dtype=float)
+    if w.sum() <= 0 or o.sum() <= 0:
+        return None
+    e = w / w.sum() * o.sum()
+    positive = e > 0
+    if np.any(e[positive] < min_expected):
+        return None
+    df = int(np.count_nonzero(positive)) - 1
+    if df <= 0:
+        return None
+    if np.any(o[~positive] > 0):
+        # Observations in a group with zero weight: a mismatch regardless of the statistic.
+        return {"chi2": None, "df": df, "p_value": 0.0}
+    chi2 = float(np.sum((o[positive] - e[positive]) ** 2 / e[positive]))
+    return {"chi2": chi2, "df": df, "p_value": chi2_sf(chi2, df)}
+
+def chi2_independence(table: dict, min_expected: float = 5) -> dict:
+    # Pearson chi-square test of independence for a {(row, col): count} table.
+    rows = sorted({r for r, _ in table}, key=str)
+    cols = sorted({c for _, c in table}, key=str)
+    if len(rows) < 2 or len(cols) < 2:
+        return None
+    o = np.array([[table.get((r, c), 0) for c in cols] for r in rows], dtype=float)
+    e = np.outer(o.sum(axis=1), o.sum(axis=0)) / o.sum()
+    if np.any(e < min_expected):
+        return None
+    chi2 = float(np.sum((o - e) ** 2 / e))
+    df = (len(rows) - 1) * (len(cols) - 1)
+    return {"chi2": chi2, "df": df, "p_value": chi2_sf(chi2, df)}
+
+def proportion_intervals(visits: np.ndarray, clicks: np.ndarray, z: float = Z95) -> dict:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ctr = np.where(visits > 0, clicks / visits, np.nan)
+        se = np.sqrt(ctr * (1 - ctr) / visits)
+        denom = 1 + z * z / visits
+        center = (ctr + z * z / (2 * visits)) / denom
+        half = z * np.sqrt(ctr * (1 - ctr) / visits + z * z / (4 * visits * visits)) / denom
+    return {
+        "ctr": ctr,
+        "normal_low": ctr - z * se,
+        "normal_high": ctr + z * se,
+        "wilson_low": center - half,
+        "wilson_high": center + half
+    }
+
+def two_proportion_test(v1, c1, v2, c2) -> tuple:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p1, p2 = c1 / v1, c2 / v2
+        pooled = (c1 + c2) / (v1 + v2)
+        se = np.sqrt(pooled * (1 - pooled) * (1 / v1 + 1 / v2))
+        z = (p1 - p2) / se
+        lift = p1 / p2 - 1
+    return z, 2 * normal_sf(np.abs(z)), lift
+
+def report(experiments: dict) -> dict:
+    # experiments: name -> {"control": group, "groups": [...], "visits": [...],
+    #                       "clicks": [...], "devices": [...], "weights": [...]}
+    # All groups of all experiments are evaluated together as flat arrays.
+    names = list(experiments)
+    groups, exp_idx, ctrl_idx = [], [], []
+    for i, name in enumerate(names):
+        exp = experiments[name]
+        offset = len(groups)
+        groups.extend(exp["groups"])
+        exp_idx.extend([i] * len(exp["groups"]))
+        control = exp["groups"].index(exp["control"]) if exp.get("control") in exp["groups"] else 0
+        ctrl_idx.extend([offset + control] * len(exp["groups"]))
+    if not groups:
+        return {}
+    cat = lambda key: np.array([x for name in names for x in experiments[name][key]], dtype=float)
+    visits, clicks, devices, weights = cat("visits"), cat("clicks"), cat("devices"), cat("weights")
+    exp_idx, ctrl_idx = np.array(exp_idx), np.array(ctrl_idx)
+
+    intervals = proportion_intervals(visits, clicks)
+    z, p_value, lift = two_proportion_test(visits, clicks, visits[ctrl_idx], clicks[ctrl_idx])
+    is_control = np.arange(len(groups)) == ctrl_idx
+    for a in (z, p_value, lift):
+        a[is_control] = np.nan
+
+    n_exps = len(names)
+    total_devices = np.bincount(exp_idx, weights=devices, minlength=n_exps)
+    total_weight = np.bincount(exp_idx, weights=weights, minlength=n_exps)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = weights / total_weight[exp_idx] * total_devices[exp_idx]
+        contrib = np.where(expected > 0, (devices - expected) ** 2 / expected, 0.0)
+    chi2 = np.bincount(exp_idx, weights=contrib, minlength=n_exps)
+    df = np.bincount(exp_idx, weights=(weights > 0).astype(float), minlength=n_exps) - 1
+
+    value = lambda x: None if not np.isfinite(x) else float(x)
+    result = {}
+    for i, name in enumerate(names):
+        rows = np.nonzero(exp_idx == i)[0]
+        srm_p = chi2_sf(chi2[i], int(df[i])) if df[i] > 0 and total_devices[i] > 0 else float("nan")
+        result[name] = {
+            "control": groups[ctrl_idx[rows[0]]],
+            "groups": {
+                groups[j]: {
+                    "visits": int(visits[j]),
+                    "clicks": int(clicks[j]),
+                    "devices": int(devices[j]),
+                    "ctr": value(intervals["ctr"][j]),
+                    "ci_normal": [value(intervals["normal_low"][j]), value(intervals["normal_high"][j])],
+                    "ci_wilson": [value(intervals["wilson_low"][j]), value(intervals["wilson_high"][j])],
+                    "lift": value(lift[j]),
+                    "z": value(z[j]),
+                    "p_value": value(p_value[j])
+                } for j in rows
+            },
+            "srm": {
+                "chi2": value(chi2[i]) if df[i] > 0 else None,
+                "df": int(max(df[i], 0)),
+                "p_value": value(srm_p),
+                "mismatch": bool(srm_p < SRM_ALPHA)
+            }
+        }
+    return result
@@ -0,0 +1,284 @@
+import hmac
+import json
+import base64
+import hashlib
+from math import lcm
+from types import MappingProxyType
+from bisect import bisect_right
+from itertools import accumulate
+from collections import Counter
+from typing import NamedTuple, Optional
+import numpy as np
+
+class CompiledExperiment(NamedTuple):
+    state: str
+    fallback: str
+    rollout_group: Optional[str]
+    total: int
+    names: tuple
+    bounds: tuple
+    hash: str = "sha256"
+    layer: Optional[str] = None
+    start: int = 0
+    table: tuple = ()
+
+class CompiledLayer(NamedTuple):
+    hash: str
+    slots: tuple
+
+class CompiledConfig(NamedTuple):
+    # Everything a request reads about the experiments, swapped as one object on updates.
+    experiments: MappingProxyType
+    layers: MappingProxyType
+    epoch: str
+
+# Bucketing hashes of f"{device_id}:{experiment}" as integers. sha256 over the full
+# digest is the original scheme and the default; changing the hash of a running experiment reshuffles it.
+HASHES = {
+    "sha256": lambda key: int.from_bytes(hashlib.sha256(key).digest(), 'big'),
+    "blake2b64": lambda key: int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'big'),
+}
+DEFAULT_HASH = "sha256"
+BUCKETS = 10000
+MOVED_EXACT_POINTS = 1_000_000
+
+def compile_experiment(info: dict) -> CompiledExperiment:
+    hash_name = info.get("hash", DEFAULT_HASH)
+    if hash_name not in HASHES:
+        raise ValueError(f"Unknown hash '{hash_name}', expected one of {', '.join(HASHES)}")
+    names = tuple(sorted(info["groups"]))
+    bounds = []
+    c = 0
+    for g in names:
+        c += info["groups"][g]
+        bounds.append(c)
+    layer, start = info.get("layer"), 0
+    if layer is not None:
+        # A layered experiment owns buckets [start, end) of its layer, split between
+        # groups in proportion to the weights; bounds then count buckets.
+        start, end = info["buckets"]
+        if not 0 <= start < end <= BUCKETS:
+            raise ValueError(f"Invalid buckets {start}-{end} in layer '{layer}'")
+        bounds = [round(b * (end - start) / c) for b in bounds]
+        c = end - start
+    table = ()
+    if info.get("allocation") == "stable":
+        # Position -> group over BUCKETS positions (the layer range for layered experiments),
+        # kept in info["bucket_groups"] as [group, count] runs so weight changes move few buckets.
+        if layer is None:
+            c = BUCKETS
+        runs = info.get("bucket_groups")
+        table = tuple(decode_runs(runs)) if runs else tuple(allocate_buckets(info["groups"], c))
+        if len(table) != c:
+            raise ValueError(f"bucket_groups cover {len(table)} buckets, expected {c}")
+        counts = Counter(table)
+        bounds = list(accumulate(counts.get(g, 0) for g in names))
+    return CompiledExperiment(state=info["state"],
+                              fallback=info["fallback"],
+                              rollout_group=info.get("rollout_group"),
+                              total=c,
+                              names=names,
+                              bounds=tuple(bounds),
+                              hash=hash_name,
+                              layer=layer,
+                              start=start,
+                              table=table)
+
+def apportion(weights: dict, size: int) -> dict:
+    # Largest remainder: integer counts summing to size, proportional to weights.
+    names = sorted(weights)
+    total = sum(weights.values())
+    exact = {g: weights[g] * size / total for g in names}
+    counts = {g: int(exact[g]) for g in names}
+    by_remainder = sorted(names, key=lambda g: counts[g] - exact[g])
+    for g in by_remainder[:size - sum(counts.values())]:
+        counts[g] += 1
+    return counts
+
+def allocate_buckets(weights: dict, size: int, previous: list = None) -> list:
+    # Bucket -> group with apportion(weights, size) buckets per group. From a previous
+    # allocation only the buckets over a group's new count move, to groups under theirs.
+    counts = apportion(weights, size)
+    if previous is None or len(previous) != size:
+        return [g for g in sorted(counts) for _ in range(counts[g])]
+    table = list(previous)
+    have = Counter(table)
+    freed = []
+    for b in range(size - 1, -1, -1):
+        g = table[b]
+        if have[g] > counts.get(g, 0):
+            have[g] -= 1
+            freed.append(b)
+    freed.reverse()
+    for g in sorted(counts):
+        for _ in range(counts[g] - have[g]):
+            table[freed.pop()] = g
+    return table
+
+def encode_runs(table: list) -> list:
+    runs = []
+    for g in table:
+        if runs and runs[-1][0] == g:
+            runs[-1][1] += 1
+        else:
+            runs.append([g, 1])
+    return runs
+
+def decode_runs(runs: list) -> list:
+    return [g for g, n in runs for _ in range(n)]
+
+def compile_experiments(experiments: dict) -> dict:
+    return {name: compile_experiment(info) for name, info in experiments.items()}
+
+def compile_layers(compiled: dict) -> dict:
+    # slots[bucket] is (experiment, group) for buckets of active experiments, otherwise None,
+    # so a device is in at most one experiment of a layer.
+    hashes, slots, owners = {}, {}, {}
+    for name, exp in sorted(compiled.items()):
+        if exp.layer is None:
+            continue
+        if exp.layer not in slots:
+            hashes[exp.layer] = exp.hash
+            slots[exp.layer] = [None] * BUCKETS
+            owners[exp.layer] = [None] * BUCKETS
+        elif hashes[exp.layer] != exp.hash:
+            raise ValueError(f"Experiments in layer '{exp.layer}' use different hashes")
+        owner = owners[exp.layer]
+        for b in range(exp.start, exp.start + exp.total):
+            if owner[b] is not None:
+                raise ValueError(f"Experiments '{owner[b]}' and '{name}' overlap in layer '{exp.layer}'")
+            owner[b] = name
+            if exp.state == "active":
+                slots[exp.layer][b] = (name, pick_group(exp, b - exp.start))
+    return {layer: CompiledLayer(hashes[layer], tuple(slots[layer])) for layer in slots}
+
+def layer_bucket(device_id: str, layer: str, hash_name: str = DEFAULT_HASH) -> int:
+    return hash_mod(device_id, f"layer:{layer}", BUCKETS, hash_name)
+
+def compile_config(compiled: dict) -> CompiledConfig:
+    return CompiledConfig(experiments=MappingProxyType(dict(compiled)),
+                          layers=MappingProxyType(compile_layers(compiled)),
+                          epoch=config_epoch(compiled))
+
+def config_epoch(compiled: dict) -> str:
+    # Changes whenever any experiment's compiled config changes, across restarts too.
+    key = repr(sorted(compiled.items())).encode()
+    return hashlib.blake2b(key, digest_size=6).hexdigest()
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _token_signature(secret: bytes, device_id: str, epoch: str, payload: str) -> str:
+    msg = f"{device_id}.{epoch}.{payload}".encode()
+    return _b64(hmac.new(secret, msg, hashlib.sha256).digest()[:16])
+
+def make_token(secret: bytes, device_id: str, epoch: str, groups: dict) -> str:
+    # "<epoch>.<groups>.<hmac>": the groups are a base64 JSON list in experiment name order,
+    # the HMAC also covers the device id, so a token is only valid for its own device.
+    payload = _b64(json.dumps([groups[name] for name in sorted(groups)], separators=(",", ":")).encode())
+    return f"{epoch}.{payload}.{_token_signature(secret, device_id, epoch, payload)}"
+
+def read_token(secret: bytes, token: str, device_id: str, epoch: str, experiments) -> Optional[dict]:
+    # Groups from a token issued for device_id under the current epoch, otherwise None.
+    parts = token.split(".") if token else ()
+    if len(parts) != 3 or parts[0] != epoch:
+        return None
+    _, payload, signature = parts
+    if not hmac.compare_digest(signature.encode(), _token_signature(secret, device_id, epoch, payload).encode()):
+        return None
+    names = sorted(experiments)
+    groups = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    if len(groups) != len(names):
+        return None
+    return dict(zip(names, groups))
+
+def moved_fraction(old: CompiledExperiment, new: CompiledExperiment) -> float:
+    # Share of devices whose hashed group differs between two configs of one experiment.
+    # Both configs hash a device to the same number h, so h mod lcm(old.total, new.total)
+    # fixes both positions and the count over that period is exact. Layers map buckets
+    # directly, so that needs the same range. Otherwise positions are unrelated (or one side
+    # is constant) and it is 1 - P(same group) over the group weights.
+    period = None
+    if old.state == new.state == "active" and old.layer == new.layer and old.hash == new.hash:
+        if old.layer is None:
+            period = lcm(old.total, new.total)
+        elif old.start == new.start and old.total == new.total:
+            period = old.total
+    if period:
+        if old.table or new.table:
+            points = range(period + 1) if period <= MOVED_EXACT_POINTS else None
+        elif sum(period // e.total * (len(e.bounds) + 1) for e in (old, new)) <= MOVED_EXACT_POINTS:
+            points = sorted({period, *(k + b for e in (old, new) for k in range(0, period, e.total)
+                                       for b in (0,) + e.bounds if b < e.total)})
+        else:
+            points = None
+        if points is not None:
+            moved = sum(b - a for a, b in zip(points, points[1:])
+                        if pick_group(old, a % old.total) != pick_group(new, a % new.total))
+            return moved / period
+    w_old, w_new = expected_weights(old), expected_weights(new)
+    t_old, t_new = sum(w_old.values()), sum(w_new.values())
+    return 1 - sum(w * w_new.get(g, 0) for g, w in w_old.items()) / (t_old * t_new)
+
+def expected_weights(compiled: CompiledExperiment) -> dict:
+    if compiled.state == "active":
+        return {g: b - a for g, a, b in zip(compiled.names, (0,) + compiled.bounds, compiled.bounds)}
+    elif compiled.state == "rollout":
+        return {compiled.rollout_group: 1}
+    return {compiled.fallback: 1}
+
+def pick_group(compiled: CompiledExperiment, hash_mod: int) -> str:
+    if compiled.table:
+        return compiled.table[hash_mod]
+    i = bisect_right(compiled.bounds, hash_mod)
+    return compiled.names[i] if i < len(compiled.names) else compiled.fallback
+
+def hash_mod(device_id: str, experiment: str, total_parts: int, hash_name: str = DEFAULT_HASH) -> int:
+    key = f"{device_id}:{experiment}"
+    return HASHES[hash_name](key.encode()) % total_parts
+
+def batch_hash_mod(device_ids: list, experiment: str, total_parts: int,
+                   hash_name: str = DEFAULT_HASH) -> np.ndarray:
+    # sha256 and blake2b64 are reduced with NumPy; other HASHES entries and totals too large
+    # for the limb reduction use Python integers, one device at a time.
+    if hash_name not in HASHES:
+        raise ValueError(f"Unknown hash '{hash_name}'")
+    if hash_name not in ("sha256", "blake2b64") or total_parts >= 2**32:
+        return np.array([hash_mod(d, experiment, total_parts, hash_name) for d in device_ids], dtype=object)
+    suffix = f":{experiment}".encode()
+    total = np.uint64(total_parts)
+    if hash_name == "blake2b64":
+        digests = b"".join(hashlib.blake2b(str(d).encode() + suffix, digest_size=8).digest() for d in device_ids)
+        return np.frombuffer(digests, dtype='>u8').astype(np.uint64) % total
+    # The sha256 digest is split into eight big-endian 32-bit limbs and reduced
+    # limb by limb, so the result equals int.from_bytes(digest) % total_parts
+    # without 256-bit integers, as long as total_parts < 2**32.
+    digests = b"".join(hashlib.sha256(str(d).encode() + suffix).digest() for d in device_ids)
+    limbs = np.frombuffer(digests, dtype='>u4').reshape(-1, 8).astype(np.uint64)
+    shift = np.uint64(32)
+    r = np.zeros(len(device_ids), dtype=np.uint64)
+    for i in range(8):
+        r = ((r << shift) | limbs[:, i]) % total
+    return r
+
+def batch_assign(device_ids: list, experiment: str, compiled: CompiledExperiment) -> list:
+    # None for devices outside the buckets of a layered experiment.
+    if not device_ids:
+        return []
+    if compiled.layer is not None:
+        buckets = batch_hash_mod(device_ids, f"layer:{compiled.layer}", BUCKETS, compiled.hash)
+        hashes = buckets.astype(np.int64) - compiled.start
+        outside = (hashes < 0) | (hashes >= compiled.total)
+    else:
+        hashes = batch_hash_mod(device_ids, experiment, compiled.total, compiled.hash)
+        outside = None
+    if compiled.table:
+        groups = np.array(compiled.table, dtype=object)[np.clip(hashes, 0, compiled.total - 1)]
+    else:
+        bounds = np.array(compiled.bounds, dtype=hashes.dtype)
+        idx = np.searchsorted(bounds, hashes, side='right')
+        lookup = np.array(compiled.names + (compiled.fallback,), dtype=object)
+        groups = lookup[np.minimum(idx, len(compiled.names))]
+    if outside is not None:
+        groups[outside] = None
+    return groups.tolist()
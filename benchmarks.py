@@ -0,0 +1,208 @@
+import os
+import sys
+import uuid
+import atexit
+import shutil
+import argparse
+import tempfile
+import importlib
+from timeit import timeit
+from collections import Counter
+import numpy as np
+
+if "EVENTS_DIR" not in os.environ:
+    os.environ["EVENTS_DIR"] = tempfile.mkdtemp(prefix="ab-bench-events-")
+    atexit.register(shutil.rmtree, os.environ["EVENTS_DIR"], True)
+rollout = importlib.import_module("9_rollout")
+
+def legacy_post_event(event_name: str, device_id: str, params: dict):
+    payload = {
+        "ts": rollout.datetime.utcnow().isoformat(),
+        "deviceId": device_id,
+        "source": 'backend',
+        "event": event_name,
+        "params": params
+    }
+    with rollout.app.test_request_context("/events", method="POST", json=payload):
+        return rollout.events()
+
+def report(name: str, seconds: float, n: int):
+    print(f"{name}: {seconds / n * 1e6:.2f} us/call")
+
+def bench_post_event(n: int):
+    device_id = str(uuid.uuid4())
+    params = {exp_name: {"state": exp.state, "fallback": exp.fallback, "group": exp.fallback}
+              for exp_name, exp in rollout.CONFIG.experiments.items()}
+    legacy = timeit(lambda: legacy_post_event("exp_groups", device_id, params), number=n)
+    direct = timeit(lambda: rollout.post_event("exp_groups", device_id, params), number=n)
+    print("post_event, exp_groups event:")
+    report("  test_request_context", legacy, n)
+    report("  ingest_event", direct, n)
+    print(f"  saved {(legacy - direct) / n * 1e6:.2f} us/call")
+
+def bench_expgroups(n: int):
+    client = rollout.app.test_client()
+    device_ids = [str(uuid.uuid4()) for _ in range(n)]
+    it = iter(device_ids)
+    t = timeit(lambda: client.get(f"/api/expgroups?device_id={next(it)}"), number=n)
+    print("/api/expgroups, new devices:")
+    report("  request", t, n)
+    device_id = device_ids[0]
+    client.get(f"/api/expgroups?device_id={device_id}")
+    t = timeit(lambda: client.get(f"/api/expgroups?device_id={device_id}"), number=n)
+    print("/api/expgroups, returning device with assignment token:")
+    report("  request", t, n)
+    t = timeit(lambda: rollout.exp_groups(device_id), number=n)
+    print("exp_groups, returning device:")
+    report("  from ASSIGNEDGROUPS", t, n)
+    token = client.get_cookie(rollout.TOKEN_COOKIE).value
+    t = timeit(lambda: rollout.exp_groups(device_id, token), number=n)
+    report("  from token", t, n)
+
+def bench_index(n: int):
+    from flask import render_template_string
+    with rollout.app.test_request_context("/"):
+        legacy = timeit(lambda: render_template_string(rollout.INDEX_TEMPLATE), number=n)
+        cached = timeit(lambda: rollout.render_page(rollout.INDEX_PAGE), number=n)
+    print("index page:")
+    report("  render_template_string", legacy, n)
+    report("  render_page", cached, n)
+
+def bench_hashes(n: int):
+    # Throughput and uniformity of each assignment.HASHES entry over n random device ids:
+    # chi-square of 100 equal buckets, of a 1/99 split and independence of two experiments.
+    assignment = rollout.assignment
+    analysis = rollout.analysis
+    device_ids = [str(uuid.uuid4()) for _ in range(n)]
+    it = iter(device_ids * 2)
+    for name in assignment.HASHES:
+        print(f"{name}:")
+        t = timeit(lambda: assignment.hash_mod(next(it), "exp", 100, name), number=n)
+        report("  hash_mod", t, n)
+        t = timeit(lambda: assignment.batch_hash_mod(device_ids, "exp", 100, name), number=1)
+        report("  batch_hash_mod, per id", t, n)
+        buckets = assignment.batch_hash_mod(device_ids, "exp", 100, name)
+        other = assignment.batch_hash_mod(device_ids, "other", 10, name)
+        split = assignment.batch_hash_mod(device_ids, "split", 100, name) < 1
+        checks = {
+            "100 buckets": analysis.chi2_goodness_of_fit(
+                dict(enumerate(np.bincount(buckets.astype(np.intp), minlength=100))), {b: 1 for b in range(100)}),
+            "1/99 split": analysis.chi2_goodness_of_fit(
+                {True: int(split.sum()), False: int((~split).sum())}, {True: 1, False: 99}),
+            "independence": analysis.chi2_independence(
+                Counter(zip((buckets // 10).tolist(), other.tolist())))
+        }
+        for check, result in checks.items():
+            if result is None:
+                print(f"  {check}: too few devices")
+            else:
+                print(f"  {check}: chi2={result['chi2']:.1f} df={result['df']} p={result['p_value']:.3f}")
+
+def bench_layers(n: int):
+    # Groups of one device in 200 active experiments, independent or 20 per layer.
+    assignment = rollout.assignment
+    base = {"groups": {"A": 1, "B": 1}, "fallback": "A", "state": "active"}
+    independent = assignment.compile_experiments({f"exp{i}": base for i in range(200)})
+    layered = assignment.compile_experiments({f"exp{i}": dict(base, layer=f"layer{i // 20}",
+                                                              buckets=[i % 20 * 500, i % 20 * 500 + 500])
+                                              for i in range(200)})
+    layers = assignment.compile_layers(layered)
+    device_ids = iter([str(uuid.uuid4()) for _ in range(2 * n)])
+
+    def assign_independent():
+        device_id = next(device_ids)
+        return {name: assignment.pick_group(exp, assignment.hash_mod(device_id, name, exp.total, exp.hash))
+                for name, exp in independent.items()}
+
+    def assign_layered():
+        device_id = next(device_ids)
+        return dict(layer.slots[assignment.layer_bucket(device_id, name, layer.hash)] or (None, None)
+                    for name, layer in layers.items())
+
+    print("groups in 200 experiments:")
+    report("  independent, 200 hashes", timeit(assign_independent, number=n), n)
+    report("  10 layers, 10 hashes", timeit(assign_layered, number=n), n)
+
+def bench_reshuffle(n: int):
+    # Share of devices moved by a sequence of weight edits, cumulative bounds vs stable allocation.
+    assignment = rollout.assignment
+    edits = [{"A": 50, "B": 50}, {"A": 30, "B": 70}, {"A": 60, "B": 140}, {"A": 45, "B": 55}, {"A": 1, "B": 1}]
+    base = {"fallback": "A", "state": "active"}
+    print("moved devices per weight edit:")
+    print(f"  {'edit':<28}{'cumulative':>12}{'stable':>12}")
+    previous = edits[0]
+    old = assignment.compile_experiment(dict(base, groups=previous))
+    old_stable = assignment.compile_experiment(dict(base, groups=edits[0], allocation="stable"))
+    for weights in edits[1:]:
+        new = assignment.compile_experiment(dict(base, groups=weights))
+        table = assignment.allocate_buckets(weights, old_stable.total, list(old_stable.table))
+        new_stable = assignment.compile_experiment(dict(base, groups=weights, allocation="stable",
+                                                        bucket_groups=assignment.encode_runs(table)))
+        edit = f"{previous['A']}:{previous['B']} -> {weights['A']}:{weights['B']}"
+        print(f"  {edit:<28}{assignment.moved_fraction(old, new):>12.1%}{assignment.moved_fraction(old_stable, new_stable):>12.1%}")
+        old, old_stable, previous = new, new_stable, weights
+
+def report_input(aggs, exp_name: str, exp: dict) -> dict:
+    groups = sorted(exp["groups"])
+    stats = aggs.stats(exp_name)["groups"]
+    empty = {"pageviews": 0, "clicks": 0, "devices": 0}
+    return {
+        "control": exp["fallback"],
+        "groups": groups,
+        "visits": [stats.get(g, empty)["pageviews"] for g in groups],
+        "clicks": [stats.get(g, empty)["clicks"] for g in groups],
+        "devices": [stats.get(g, empty)["devices"] for g in groups],
+        "weights": [exp["groups"][g] for g in groups]
+    }
+
+def bench_aggregates(n: int):
+    # n devices of generate_events.py output, about 4 events per device.
+    import generate_events
+    directory = tempfile.mkdtemp(prefix="ab-bench-generated-")
+    try:
+        experiments = generate_events.DEFAULT_EXPERIMENTS
+        store = rollout.eventlog.EventStore(directory, buffer_size=50000)
+        for chunk in generate_events.generate(experiments, n, 2.0, 24.0, 0, rollout.datetime(2025, 1, 1)):
+            store.extend(chunk)
+        store.flush()
+        events = []
+        t = timeit(lambda: events.extend(store), number=1)
+        print(f"{len(events)} events from {n} devices:")
+        report("  EventStore read, per event", t, len(events))
+        aggs = rollout.aggregates.ExperimentAggregates()
+        end = rollout.datetime(2025, 1, 2).timestamp()
+        uniques = rollout.aggregates.UniqueDevices(aggs.device_groups, clock=lambda: end)
+        for name, consume in (("ExperimentAggregates", aggs.extend), ("UniqueDevices", uniques.extend)):
+            t = timeit(lambda: [consume(events[i:i + 10000]) for i in range(0, len(events), 10000)], number=1)
+            report(f"  {name}.extend, per event", t, len(events))
+        inputs = {name: report_input(aggs, name, exp) for name, exp in experiments.items()}
+        t = timeit(lambda: rollout.analysis.report(inputs), number=100)
+        report("  analysis.report", t, 100)
+    finally:
+        shutil.rmtree(directory, True)
+
+BENCHMARKS = {
+    "post_event": bench_post_event,
+    "expgroups": bench_expgroups,
+    "index": bench_index,
+    "hashes": bench_hashes,
+    "layers": bench_layers,
+    "reshuffle": bench_reshuffle,
+    "aggregates": bench_aggregates,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for 9_rollout.py")
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS),
+                        help=f"Benchmarks to run: {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument("-n", "--number", type=int, default=10000,
+                        help="Calls per benchmark (default: 10000)")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            sys.exit(f"Unknown benchmark: {name}")
+        BENCHMARKS[name](args.number)
+        print("")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,526 @@
+import os
+import json
+import time
+import struct
+import atexit
+import logging
+import threading
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+import numpy as np
+
+# A segment file is a sequence of blocks, each holding a batch of events column by column:
+#   b"EVB1" | uint32 header length | JSON header | column bytes
+# The header lists the event count, column sizes and the dictionary entries
+# for deviceId, source and event first seen in this block.
+# Dictionaries restart with every segment, so segments are readable on their own.
+log = logging.getLogger(__name__)
+
+MAGIC = b"EVB1"
+DICT_COLUMNS = ("deviceId", "source", "event")
+KNOWN_KEYS = ("ts",) + DICT_COLUMNS + ("params",)
+
+def parse_ts(ts) -> int:
+    try:
+        dt = datetime.fromisoformat(str(ts).replace("Z", "+00:00"))
+    except ValueError:
+        return int(time.time() * 1_000_000)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1_000_000)
+
+def format_ts(ts_us: int) -> str:
+    dt = datetime.fromtimestamp(ts_us / 1_000_000, tz=timezone.utc)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+def encode_strings(values: list) -> tuple:
+    encoded = [v.encode() for v in values]
+    offsets = np.cumsum([0] + [len(v) for v in encoded], dtype=np.uint32)
+    return offsets.tobytes(), b"".join(encoded)
+
+def decode_strings(offsets: np.ndarray, blob: bytes) -> list:
+    return [blob[offsets[i]:offsets[i + 1]].decode() for i in range(len(offsets) - 1)]
+
+class Segment:
+    # Segment files are created exclusively, so processes sharing a directory
+    # never append to each other's segments (their dictionary codes differ).
+    def __init__(self, path: str):
+        self.path = path
+        self.file = os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND), "ab")
+        self.created = time.time()
+        self.dicts = {c: {} for c in DICT_COLUMNS}
+
+    def write_block(self, buffer: dict):
+        n = len(buffer["ts"])
+        new_entries = {}
+        columns = [np.array(buffer["ts"], dtype='<i8').tobytes()]
+        for c in DICT_COLUMNS:
+            codes = self.dicts[c]
+            new_entries[c] = []
+            col = np.empty(n, dtype='<u4')
+            for i, v in enumerate(buffer[c]):
+                code = codes.get(v)
+                if code is None:
+                    code = codes[v] = len(codes)
+                    new_entries[c].append(v)
+                col[i] = code
+            columns.append(col.tobytes())
+        columns.extend(encode_strings(buffer["params"]))
+        columns.extend(encode_strings(buffer["extra"]))
+        header = json.dumps({"n": n, "dicts": new_entries, "sizes": [len(c) for c in columns]}).encode()
+        self.file.write(MAGIC + struct.pack("<I", len(header)) + header + b"".join(columns))
+        self.file.flush()
+
+    def size(self) -> int:
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+class SegmentIndex:
+    # Event positions, column offsets and dictionaries of the blocks of one segment file.
+    # refresh() reads only the headers of blocks appended since the last call,
+    # so a page of a scan does not re-read the segment from the start.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.starts = []
+        self.blocks = []
+        self.dicts = {c: [] for c in DICT_COLUMNS}
+        self.codes = {c: {} for c in DICT_COLUMNS}
+        self.end = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        with self.lock, open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            while self.end + 8 <= size:
+                f.seek(self.end)
+                prefix = f.read(8)
+                if prefix[:4] != MAGIC:
+                    return
+                (header_len,) = struct.unpack_from("<I", prefix, 4)
+                offset = self.end + 8 + header_len
+                if offset > size:
+                    return
+                header = json.loads(f.read(header_len))
+                if offset + sum(header["sizes"]) > size:
+                    return
+                for c in DICT_COLUMNS:
+                    for v in header["dicts"][c]:
+                        self.codes[c].setdefault(v, len(self.dicts[c]))
+                        self.dicts[c].append(v)
+                self.starts.append(self.count)
+                self.blocks.append((self.count, header["n"], offset, header["sizes"]))
+                self.count += header["n"]
+                self.end = offset + sum(header["sizes"])
+
+def read_blocks(path: str, skip: int = 0, index: SegmentIndex = None):
+    # Yields (position of the first event in the segment, event count, dictionaries, raw columns)
+    # for the blocks holding events at positions >= skip; earlier blocks are not read.
+    # The dictionaries cover the whole segment.
+    index = index or SegmentIndex(path)
+    index.refresh()
+    first = max(bisect_right(index.starts, skip) - 1, 0)
+    with open(path, "rb") as f:
+        for start, n, offset, sizes in index.blocks[first:]:
+            f.seek(offset)
+            data = f.read(sum(sizes))
+            cols = []
+            pos = 0
+            for size in sizes:
+                cols.append(data[pos:pos + size])
+                pos += size
+            yield start, n, index.dicts, cols
+
+def block_event(i: int, dicts: dict, cols: list) -> dict:
+    ts = np.frombuffer(cols[0], dtype='<i8', count=1, offset=8 * i)[0]
+    codes = [np.frombuffer(cols[1 + j], dtype='<u4', count=1, offset=4 * i)[0] for j in range(len(DICT_COLUMNS))]
+    strings = []
+    for offsets, blob in ((cols[4], cols[5]), (cols[6], cols[7])):
+        a, b = np.frombuffer(offsets, dtype='<u4', count=2, offset=4 * i)
+        strings.append(blob[a:b].decode())
+    return make_event(int(ts), *(dicts[c][codes[j]] for j, c in enumerate(DICT_COLUMNS)), *strings)
+
+def read_segment(path: str):
+    for start, n, dicts, cols in read_blocks(path):
+        ts = np.frombuffer(cols[0], dtype='<i8')
+        codes = [np.frombuffer(cols[1 + i], dtype='<u4') for i in range(len(DICT_COLUMNS))]
+        params = decode_strings(np.frombuffer(cols[4], dtype='<u4'), cols[5])
+        extra = decode_strings(np.frombuffer(cols[6], dtype='<u4'), cols[7])
+        for i in range(n):
+            yield make_event(int(ts[i]),
+                             *(dicts[c][codes[j][i]] for j, c in enumerate(DICT_COLUMNS)),
+                             params[i], extra[i])
+
+def parse_cursor(cursor) -> tuple:
+    if not cursor:
+        return 0, 0
+    seg, pos = str(cursor).split(":")
+    return int(seg), int(pos)
+
+def format_cursor(seg: int, pos: int) -> str:
+    return f"{seg}:{pos}"
+
+def event_error(event) -> str:
+    # Why an event can't be stored, or None. deviceId, source and event are dictionary-encoded
+    # and must be strings when present. ts must be an ISO 8601 string when present;
+    # events without one are stored with the server time.
+    if not isinstance(event, dict):
+        return "Event must be a JSON object"
+    for c in DICT_COLUMNS:
+        v = event.get(c)
+        if v is not None and not isinstance(v, str):
+            return f"'{c}' must be a string"
+    ts = event.get("ts")
+    if ts is not None:
+        try:
+            datetime.fromisoformat(ts.replace("Z", "+00:00"))
+        except (ValueError, AttributeError):
+            return "'ts' must be an ISO 8601 timestamp"
+    return None
+
+def make_event(ts: int, device_id, source, event, params: str, extra: str) -> dict:
+    e = {
+        "ts": format_ts(ts),
+        "deviceId": device_id,
+        "source": source,
+        "event": event,
+        "params": json.loads(params)
+    }
+    if extra:
+        e.update(json.loads(extra))
+    return e
+
+class EventStore:
+    # Append-only event log. Events are buffered column by column in memory
+    # and written as a block once the buffer holds buffer_size events
+    # or is older than flush_interval seconds. A new segment file is started
+    # when the current one exceeds segment_bytes or segment_seconds.
+
+    MAX_INDEXES = 16
+
+    def __init__(self, directory: str, buffer_size: int = 10000, flush_interval: float = 1.0,
+                 segment_bytes: int = 64 * 1024 * 1024, segment_seconds: float = 3600):
+        self.directory = directory
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.next_index = max([self._segment_index(f) for f in os.listdir(directory)] + [0]) + 1
+        self.segment = None
+        self.indexes = OrderedDict()
+        self.index_lock = threading.Lock()
+        self.buffer = self._empty_buffer()
+        self.buffer_started = None
+        atexit.register(self.close)
+
+    @staticmethod
+    def _segment_index(filename: str) -> int:
+        if filename.startswith("segment-") and filename.endswith(".evl"):
+            return int(filename[len("segment-"):-len(".evl")])
+        return 0
+
+    @staticmethod
+    def _empty_buffer() -> dict:
+        return {c: [] for c in KNOWN_KEYS + ("extra",)}
+
+    def segment_paths(self) -> list:
+        files = [f for f in os.listdir(self.directory) if self._segment_index(f)]
+        return [os.path.join(self.directory, f) for f in sorted(files, key=self._segment_index)]
+
+    def _index(self, path: str) -> SegmentIndex:
+        # Indexes of recently scanned segments, kept for cursor pagination.
+        with self.index_lock:
+            index = self.indexes.get(path)
+            if index is None:
+                index = self.indexes[path] = SegmentIndex(path)
+                while len(self.indexes) > self.MAX_INDEXES:
+                    self.indexes.popitem(last=False)
+            self.indexes.move_to_end(path)
+            return index
+
+    def append(self, event: dict):
+        self.extend([event])
+
+    @staticmethod
+    def _encode(event: dict) -> tuple:
+        values = []
+        for c in DICT_COLUMNS:
+            v = event.get(c)
+            values.append(v if v is None or isinstance(v, str) else json.dumps(v))
+        extra = {k: v for k, v in event.items() if k not in KNOWN_KEYS}
+        return (parse_ts(event.get("ts")), *values, json.dumps(event.get("params", {})),
+                json.dumps(extra) if extra else "")
+
+    def extend(self, events: list):
+        # All events are encoded before any is buffered, so a failing event leaves the buffer as it was.
+        rows = [self._encode(event) for event in events]
+        with self.lock:
+            b = self.buffer
+            for row in rows:
+                for c, v in zip(KNOWN_KEYS + ("extra",), row):
+                    b[c].append(v)
+                if len(b["ts"]) >= self.buffer_size:
+                    self._flush()
+                    b = self.buffer
+            if b["ts"] and self.buffer_started is None:
+                self.buffer_started = time.time()
+            if self.buffer_started is not None and time.time() - self.buffer_started >= self.flush_interval:
+                self._flush()
+
+    def flush_stale(self):
+        with self.lock:
+            if self.buffer_started is not None and time.time() - self.buffer_started >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.buffer["ts"]:
+            return
+        if (self.segment is None
+                or self.segment.size() >= self.segment_bytes
+                or time.time() - self.segment.created >= self.segment_seconds):
+            if self.segment is not None:
+                self.segment.close()
+            self.segment = None
+            while self.segment is None:
+                path = os.path.join(self.directory, f"segment-{self.next_index:06d}.evl")
+                self.next_index += 1
+                try:
+                    self.segment = Segment(path)
+                except FileExistsError:
+                    pass
+        self.segment.write_block(self.buffer)
+        self.buffer = self._empty_buffer()
+        self.buffer_started = None
+
+    def scan(self, cursor=None, event=None, device_id=None, source=None, since=None, until=None):
+        # Yields (cursor, event) for matching events in log order, then a final (cursor, None)
+        # pointing past everything scanned. Passing a cursor resumes right after its event.
+        # Filters are evaluated on the encoded columns; only matching events are decoded.
+        self.flush()
+        seg_from, pos_from = parse_cursor(cursor)
+        filters = {"deviceId": device_id, "source": source, "event": event}
+        since_us = parse_ts(since) if since is not None else None
+        until_us = parse_ts(until) if until is not None else None
+        end = format_cursor(seg_from, pos_from)
+        for path in self.segment_paths():
+            seg = self._segment_index(os.path.basename(path))
+            if seg < seg_from:
+                continue
+            skip = pos_from if seg == seg_from else 0
+            end = format_cursor(seg, skip)
+            index = self._index(path)
+            for start, n, dicts, cols in read_blocks(path, skip, index):
+                if start + n <= skip:
+                    continue
+                mask = np.ones(n, dtype=bool)
+                if skip > start:
+                    mask[:skip - start] = False
+                if since_us is not None or until_us is not None:
+                    ts = np.frombuffer(cols[0], dtype='<i8')
+                    if since_us is not None:
+                        mask &= ts >= since_us
+                    if until_us is not None:
+                        mask &= ts < until_us
+                for j, c in enumerate(DICT_COLUMNS):
+                    if filters[c] is None:
+                        continue
+                    code = index.codes[c].get(filters[c])
+                    if code is None:
+                        mask[:] = False
+                        break
+                    mask &= np.frombuffer(cols[1 + j], dtype='<u4') == code
+                for i in np.nonzero(mask)[0]:
+                    yield format_cursor(seg, start + int(i) + 1), block_event(int(i), dicts, cols)
+                end = format_cursor(seg, start + n)
+        yield end, None
+
+    def __iter__(self):
+        # A segment that can't be decoded is logged and skipped with the rest of it.
+        self.flush()
+        for path in self.segment_paths():
+            try:
+                yield from read_segment(path)
+            except (ValueError, KeyError, IndexError):
+                log.exception("Skipping unreadable events in %s", path)
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+
+class IngestQueue:
+    # Bounded queue in front of an EventStore. put() only appends to a deque;
+    # a background thread drains it in batches of up to batch_size.
+    # When the queue holds maxsize events, policy decides what put() does:
+    # "drop" discards the event, "block" waits for space,
+    # "spill" appends it to an NDJSON file that the writer replays later.
+    # Functions in listeners are called by the writer with every batch after it is stored.
+    # start() starts the writer; call replay() before it, so spilled events left from
+    # a previous run are not stored before the replay and then counted twice.
+    # Errors never stop the writer: events the store rejects are appended to a dead-letter
+    # NDJSON file, listener errors are logged.
+
+    POLICIES = ("drop", "block", "spill")
+
+    def __init__(self, store: EventStore, maxsize: int = 100000, policy: str = "drop",
+                 batch_size: int = 1000, interval: float = 0.05, spill_path: str = None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown backpressure policy '{policy}', expected one of {self.POLICIES}")
+        self.store = store
+        self.policy = policy
+        self.batch_size = batch_size
+        self.interval = interval
+        self.spill_path = spill_path or os.path.join(store.directory, "spill.ndjson")
+        self.dead_letter_path = os.path.join(store.directory, "deadletter.ndjson")
+        self.queue = deque()
+        self.slots = threading.BoundedSemaphore(maxsize)
+        self.spill_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.cycle = threading.Condition()
+        self.cycles = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.dead_lettered = 0
+        self.listeners = []
+        self.closed = False
+        self.writer = None
+
+    def start(self):
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def _write(self, batch: list):
+        try:
+            self.store.extend(batch)
+        except Exception:
+            log.exception("Storing %d events failed, retrying one by one", len(batch))
+            stored = []
+            for event in batch:
+                try:
+                    self.store.extend([event])
+                    stored.append(event)
+                except Exception:
+                    self._dead_letter(event)
+            batch = stored
+        self._notify(batch)
+
+    def _notify(self, batch: list):
+        for listener in self.listeners:
+            try:
+                listener(batch)
+            except Exception:
+                log.exception("Listener %r failed on %d events", listener, len(batch))
+
+    def _dead_letter(self, event):
+        with self.spill_lock:
+            with open(self.dead_letter_path, "a") as f:
+                f.write(json.dumps(event, default=str) + "\n")
+            self.dead_lettered += 1
+
+    def replay(self, batch_size: int = 10000):
+        # Feeds the events already in the store to the listeners, e.g. on start.
+        # Like the writer, it logs listener errors instead of raising them.
+        batch = []
+        for e in self.store:
+            batch.append(e)
+            if len(batch) >= batch_size:
+                self._notify(batch)
+                batch = []
+        self._notify(batch)
+
+    def put(self, event: dict) -> bool:
+        if self.policy == "block":
+            self.slots.acquire()
+        elif not self.slots.acquire(blocking=False):
+            if self.policy == "spill":
+                with self.spill_lock:
+                    with open(self.spill_path, "a") as f:
+                        f.write(json.dumps(event) + "\n")
+                    self.spilled += 1
+                return True
+            self.dropped += 1
+            return False
+        self.queue.append(event)
+        if len(self.queue) >= self.batch_size:
+            self.wakeup.set()
+        return True
+
+    def _drain(self):
+        while self.queue:
+            batch = []
+            while self.queue and len(batch) < self.batch_size:
+                batch.append(self.queue.popleft())
+            try:
+                self._write(batch)
+            finally:
+                self.slots.release(len(batch))
+
+    def _replay_spill(self):
+        with self.spill_lock:
+            if not os.path.exists(self.spill_path):
+                return
+            # Workers share the events directory, so each replays its own copy.
+            replay_path = f"{self.spill_path}.{os.getpid()}.replay"
+            os.replace(self.spill_path, replay_path)
+        with open(replay_path) as f:
+            batch = []
+            for line in f:
+                try:
+                    batch.append(json.loads(line))
+                except ValueError:
+                    self._dead_letter(line.rstrip("\n"))
+                    continue
+                if len(batch) >= self.batch_size:
+                    self._write(batch)
+                    batch = []
+            self._write(batch)
+        os.remove(replay_path)
+
+    def _write_loop(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            closed = self.closed
+            try:
+                self._drain()
+                self._replay_spill()
+                self.store.flush_stale()
+            except Exception:
+                log.exception("Event writer cycle failed")
+            with self.cycle:
+                self.cycles += 1
+                self.cycle.notify_all()
+            if closed:
+                return
+
+    def flush(self):
+        # Waits for a full writer cycle that started after the call,
+        # so every event put() before it is in the store.
+        with self.cycle:
+            target = self.cycles + 2
+            self.wakeup.set()
+            while self.cycles < target and self.writer is not None and self.writer.is_alive():
+                self.cycle.wait(self.interval)
+        self.store.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        if self.writer is not None:
+            self.writer.join()
+        self.store.flush()
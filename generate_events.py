@@ -0,0 +1,104 @@
+import json
+import argparse
+from datetime import datetime, timezone
+import numpy as np
+import assignment
+import eventlog
+from simulate_visits import CLICK_PROBS, make_device_ids
+
+DEFAULT_EXPERIMENTS = {
+    "moon_mars": {
+        "title": "Moon/Mars",
+        "groups": {'Moon': 50, 'Mars': 50},
+        "fallback": "Moon",
+        "state": "active",
+        "rollout_group": None
+    },
+    "white_gold_btn": {
+        "title": "White/Gold",
+        "groups": {'White': 50, 'Gold': 50},
+        "fallback": "White",
+        "state": "active",
+        "rollout_group": None
+    }
+}
+
+def assign_all(device_ids: list, compiled: dict) -> dict:
+    # Same groups as assign_group for devices without stored assignments.
+    groups = {}
+    for exp_name, exp in compiled.items():
+        if exp.state == "rollout":
+            groups[exp_name] = [exp.rollout_group] * len(device_ids)
+        elif exp.state == "inactive":
+            groups[exp_name] = [exp.fallback] * len(device_ids)
+        else:
+            groups[exp_name] = assignment.batch_assign(device_ids, exp_name, exp)
+    return groups
+
+def exposure(exp: assignment.CompiledExperiment, group: str) -> dict:
+    # As in exp_groups: devices outside a layered experiment see the fallback and are marked excluded.
+    if group is None:
+        return {"state": exp.state, "fallback": exp.fallback, "group": exp.fallback, "excluded": True}
+    return {"state": exp.state, "fallback": exp.fallback, "group": group}
+
+def generate(experiments: dict, devices: int, visits: float, hours: float, seed: int,
+             start: datetime, chunk: int = 10000):
+    # Yields lists of events in the /events schema, chunk devices at a time.
+    # Every device makes 1 + Poisson(visits - 1) visits at uniform random times;
+    # a visit is an exp_groups event, a pageview and, with CLICK_PROBS of its
+    # moon_mars group, a button_click. Output depends only on the arguments.
+    rng = np.random.default_rng(seed)
+    compiled = assignment.compile_experiments(experiments)
+    start_us = int(start.timestamp() * 1_000_000)
+    span_us = int(hours * 3600 * 1_000_000)
+    click_exp = "moon_mars" if "moon_mars" in compiled else next(iter(compiled))
+    for offset in range(0, devices, chunk):
+        device_ids = make_device_ids(seed, offset, min(chunk, devices - offset))
+        groups = assign_all(device_ids, compiled)
+        n_visits = 1 + rng.poisson(max(visits - 1, 0), len(device_ids))
+        visit_ts = start_us + rng.integers(0, span_us, int(n_visits.sum()))
+        clicks = rng.random(len(visit_ts))
+        events = []
+        v = 0
+        for i, device_id in enumerate(device_ids):
+            params = {exp_name: exposure(exp, groups[exp_name][i]) for exp_name, exp in compiled.items()}
+            click_prob = CLICK_PROBS.get(params[click_exp]["group"], 0)
+            for ts_us in np.sort(visit_ts[v:v + n_visits[i]]):
+                ts = eventlog.format_ts(int(ts_us))
+                events.append({"ts": ts, "deviceId": device_id, "source": "backend",
+                               "event": "exp_groups", "params": params})
+                events.append({"ts": ts, "deviceId": device_id, "source": "browser",
+                               "event": "pageview", "params": {}})
+                if clicks[v] < click_prob:
+                    events.append({"ts": ts, "deviceId": device_id, "source": "browser",
+                                   "event": "button_click", "params": {"btn_type": groups[click_exp][i]}})
+                v += 1
+        yield events
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic A/B test events into an event log directory")
+    parser.add_argument("-o", "--output", default="events", help="Event log directory (default: events)")
+    parser.add_argument("-n", "--devices", type=int, default=100000, help="Number of devices (default: 100000)")
+    parser.add_argument("--visits", type=float, default=2.0, help="Mean visits per device (default: 2)")
+    parser.add_argument("--hours", type=float, default=24.0, help="Time span of the events (default: 24)")
+    parser.add_argument("--start", default="2025-01-01T00:00:00",
+                        help="Start of the time span, UTC (default: 2025-01-01T00:00:00)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument("--experiments", help="JSON file with experiments as returned by /api/experiments")
+    args = parser.parse_args()
+
+    experiments = DEFAULT_EXPERIMENTS
+    if args.experiments:
+        with open(args.experiments) as f:
+            experiments = json.load(f)
+    start = datetime.fromisoformat(args.start).replace(tzinfo=timezone.utc)
+    store = eventlog.EventStore(args.output, buffer_size=50000)
+    total = 0
+    for events in generate(experiments, args.devices, args.visits, args.hours, args.seed, start):
+        store.extend(events)
+        total += len(events)
+    store.close()
+    print(f"{total} events for {args.devices} devices written to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import sys
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import subprocess
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+import aiohttp
+from simulate_visits import BASE_URL
+
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
+PERCENTILES = (50, 95, 99, 99.9)
+DEFAULT_MIX = "index=1,expgroups=2,events=4,update=0.01"
+
+class LatencyHistogram:
+    # Log-linear buckets in microseconds as in HdrHistogram:
+    # 64 linear sub-buckets per power of two keep the relative error below 1/64.
+    SUB_BUCKET_BITS = 6
+
+    def __init__(self, counts: dict = None):
+        self.counts = counts or {}
+        self.total = sum(self.counts.values())
+
+    def record(self, us: int):
+        shift = max(0, us.bit_length() - self.SUB_BUCKET_BITS)
+        bucket = (us >> shift) << shift
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+
+    def merge(self, other: "LatencyHistogram"):
+        for bucket, n in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + n
+        self.total += other.total
+
+    def percentile(self, p: float) -> float:
+        if not self.total:
+            return None
+        rank = p / 100 * self.total
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return bucket
+        return max(self.counts)
+
+    def summary(self) -> dict:
+        return {f"p{p:g}_ms": (self.percentile(p) / 1000 if self.total else None) for p in PERCENTILES}
+
+class Endpoint:
+    def __init__(self, name: str):
+        self.name = name
+        self.histogram = LatencyHistogram()
+        self.errors = 0
+
+async def request_index(session, device_ids):
+    async with session.get(f"{BASE_URL}/", cookies={"device_id": random.choice(device_ids)}) as resp:
+        await resp.read()
+        return resp.status
+
+async def request_expgroups(session, device_ids):
+    async with session.get(f"{BASE_URL}/api/expgroups", params={"device_id": random.choice(device_ids)}) as resp:
+        await resp.read()
+        return resp.status
+
+async def request_events(session, device_ids):
+    event = {
+        "ts": datetime.now(timezone.utc).isoformat(),
+        "deviceId": random.choice(device_ids),
+        "source": "loadtest",
+        "event": "pageview",
+        "params": {}
+    }
+    async with session.post(f"{BASE_URL}/events", json=event) as resp:
+        await resp.read()
+        return resp.status
+
+async def request_update(session, device_ids):
+    async with session.get(f"{BASE_URL}/api/experiments") as resp:
+        exps = await resp.json()
+    name = random.choice(sorted(exps))
+    exp = exps[name]
+    payload = {"name": name, "groups": exp["groups"], "state": exp["state"]}
+    if exp.get("rollout_group"):
+        payload["rollout_group"] = exp["rollout_group"]
+    async with session.post(f"{BASE_URL}/api/experiments/update", json=payload) as resp:
+        await resp.read()
+        return resp.status
+
+REQUESTS = {
+    "index": request_index,
+    "expgroups": request_expgroups,
+    "events": request_events,
+    "update": request_update,
+}
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for item in mix.split(","):
+        name, _, w = item.partition("=")
+        if name not in REQUESTS:
+            raise ValueError(f"Unknown endpoint '{name}', expected one of {', '.join(REQUESTS)}")
+        weights[name] = float(w or 1)
+    return weights
+
+async def run(rps: float, duration: float, concurrency: int, mix: dict, devices: int) -> dict:
+    # Open loop: request i is due at start + i / rps whatever the server does.
+    # Latency is measured from the due time, so queueing behind a slow server
+    # is included rather than hidden (no coordinated omission).
+    endpoints = {name: Endpoint(name) for name in mix}
+    names, weights = list(mix), list(mix.values())
+    device_ids = [str(uuid.uuid4()) for _ in range(devices)]
+    sem = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=30)
+
+    async def one(session, name, due):
+        async with sem:
+            try:
+                status = await REQUESTS[name](session, device_ids)
+                ok = status < 400
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                ok = False
+        ep = endpoints[name]
+        ep.histogram.record(int((time.perf_counter() - due) * 1_000_000))
+        if not ok:
+            ep.errors += 1
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                     cookie_jar=aiohttp.DummyCookieJar()) as session:
+        start = time.perf_counter()
+        tasks = []
+        total = int(rps * duration)
+        for i in range(total):
+            due = start + i / rps
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            name = random.choices(names, weights)[0]
+            tasks.append(asyncio.create_task(one(session, name, due)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    overall = LatencyHistogram()
+    results = {}
+    for name, ep in endpoints.items():
+        overall.merge(ep.histogram)
+        results[name] = {"count": ep.histogram.total, "errors": ep.errors,
+                         **ep.histogram.summary(), "histogram_us": ep.histogram.counts}
+    return {
+        "requests": overall.total,
+        "elapsed_s": elapsed,
+        "achieved_rps": overall.total / elapsed if elapsed else None,
+        "errors": sum(ep.errors for ep in endpoints.values()),
+        **overall.summary(),
+        "endpoints": results
+    }
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_results(results: dict, baseline: dict = None):
+    header = f"{'endpoint':<12}{'count':>8}{'errors':>8}" + "".join(f"{f'p{p:g} ms':>16}" for p in PERCENTILES)
+    print(header)
+    rows = dict(results["endpoints"], total=results)
+    for name, r in rows.items():
+        line = f"{name:<12}{r['count'] if 'count' in r else r['requests']:>8}{r['errors']:>8}"
+        for p in PERCENTILES:
+            v = r[f"p{p:g}_ms"]
+            cell = f"{v:.2f}" if v is not None else "-"
+            if baseline is not None:
+                b = baseline if name == "total" else baseline.get("endpoints", {}).get(name, {})
+                bv = b.get(f"p{p:g}_ms")
+                if v is not None and bv:
+                    cell += f"({(v / bv - 1) * 100:+.0f}%)"
+            line += f"{cell:>16}"
+        print(line)
+    print(f"achieved {results['achieved_rps']:.1f} req/s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the 9_rollout.py server on localhost")
+    parser.add_argument("--rps", type=float, default=200, help="Requests per second (default: 200)")
+    parser.add_argument("-d", "--duration", type=float, default=10, help="Duration in seconds (default: 10)")
+    parser.add_argument("-c", "--concurrency", type=int, default=100,
+                        help="Maximum requests in flight (default: 100)")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help=f"Endpoint weights, endpoints: {', '.join(REQUESTS)} (default: {DEFAULT_MIX})")
+    parser.add_argument("--devices", type=int, default=10000,
+                        help="Distinct device ids to draw from (default: 10000)")
+    parser.add_argument("-o", "--output", help="Write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    if urlparse(BASE_URL).hostname not in LOCAL_HOSTS:
+        sys.exit(f"Refusing to load test a non-local server: {BASE_URL}")
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        sys.exit(str(e))
+
+    results = asyncio.run(run(args.rps, args.duration, args.concurrency, mix, args.devices))
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "config": {"base_url": BASE_URL, "rps": args.rps, "duration": args.duration,
+                   "concurrency": args.concurrency, "mix": mix, "devices": args.devices},
+        **results
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import threading
+from datetime import datetime
+from itertools import combinations
+import analysis
+
+class SplitMonitor:
+    # Periodically checks the ingest-time counters of active experiments:
+    # "srm" compares devices per group with the configured weights,
+    # "split" compares devices per pair of groups of two experiments with the product of their weights,
+    # "independence" tests the pair table for independence using its own marginals.
+    # Checks with p-value below alpha are reported as alerts until they pass again.
+    # Devices assigned before a weight change follow the old weights and can trigger srm alerts.
+    # Devices count by their latest group seen while the experiment was active.
+
+    def __init__(self, aggregates, experiments, interval: float = 60.0, alpha: float = analysis.SRM_ALPHA):
+        self.aggregates = aggregates
+        self.experiments = experiments
+        self.interval = interval
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.checks = []
+        self.alerts = {}
+        self.checked_at = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _loop(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def check(self) -> dict:
+        weights = self.experiments()
+        checks = []
+        for name, w in weights.items():
+            observed = self.aggregates.active_group_devices(name)
+            checks.append(("srm", (name,), analysis.chi2_goodness_of_fit(observed, w)))
+        for name1, name2 in combinations(sorted(weights), 2):
+            table = self.aggregates.pair_table(name1, name2, active=True)
+            expected = {(g1, g2): w1 * w2
+                        for g1, w1 in weights[name1].items()
+                        for g2, w2 in weights[name2].items()}
+            checks.append(("split", (name1, name2), analysis.chi2_goodness_of_fit(table, expected)))
+            checks.append(("independence", (name1, name2), analysis.chi2_independence(table)))
+        now = datetime.now().isoformat()
+        results = []
+        alerts = {}
+        with self.lock:
+            for kind, exps, result in checks:
+                entry = {"check": kind, "experiments": list(exps)}
+                if result is None:
+                    entry["status"] = "insufficient data"
+                else:
+                    entry.update(result)
+                    entry["status"] = "alert" if result["p_value"] < self.alpha else "ok"
+                if entry["status"] == "alert":
+                    previous = self.alerts.get((kind, exps))
+                    entry["since"] = previous["since"] if previous else now
+                    alerts[(kind, exps)] = entry
+                results.append(entry)
+            self.checks = results
+            self.alerts = alerts
+            self.checked_at = now
+        return self.status()
+
+    def status(self) -> dict:
+        with self.lock:
+            return {"checked_at": self.checked_at,
+                    "interval": self.interval,
+                    "alerts": list(self.alerts.values()),
+                    "checks": self.checks}
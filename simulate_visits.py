@@ -1,9 +1,15 @@
+import re
 import random
 import asyncio
 import argparse
-from collections import Counter
+import json
+import uuid
+import multiprocessing
+from collections import Counter, defaultdict
 from math import sqrt
-from playwright.async_api import async_playwright
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
 import aiohttp
 
 BASE_URL = "http://127.0.0.1:5000"
@@ -12,12 +18,14 @@ CLICK_PROBS = {
     'Mars': 0.2
 }
 
+BOOTSTRAP_RE = re.compile(r"const BOOTSTRAP_GROUPS = (.*);")
 MAX_CONCURRENT = 30
 SEM = asyncio.Semaphore(MAX_CONCURRENT)
 
-async def simulate_visit(browser):
+async def simulate_visit(browser, device_id):
     async with SEM:
         context = await browser.new_context()
+        await context.add_cookies([{"name": "device_id", "value": device_id, "url": BASE_URL}])
         page = await context.new_page()
         await page.goto(BASE_URL)
         moon_mars_group = None
@@ -43,30 +51,172 @@ async def simulate_visit(browser):
         if random.random() < CLICK_PROBS.get(moon_mars_group):
             await page.click("button")
             await page.wait_for_load_state('load')
+        await page.evaluate("typeof flushEvents === 'function' ? flushEvents() : null")
         await page.close()
         await context.close()
         return moon_mars_group, white_gold_group
 
-async def fetch_events():
-    url = f"{BASE_URL}/events"
+async def simulate_http_visit(session, sem, device_id):
+    async with sem:
+        cookies = {"device_id": device_id}
+        async with session.get(f"{BASE_URL}/", cookies=cookies) as resp:
+            page = await resp.text()
+        # Groups inlined by the server, as the page script uses them; otherwise fetched like the page does.
+        bootstrap = BOOTSTRAP_RE.search(page)
+        experiments = json.loads(bootstrap.group(1)) if bootstrap else None
+        if experiments is None:
+            async with session.get(f"{BASE_URL}/api/expgroups",
+                                   params={"device_id": device_id}, cookies=cookies) as resp:
+                experiments = await resp.json()
+        moon_mars_group = experiments.get("moon_mars", {}).get("group")
+        white_gold_group = experiments.get("white_gold_btn", {}).get("group")
+        ts = datetime.now(timezone.utc).isoformat()
+        events = [{"ts": ts, "deviceId": device_id, "source": "browser", "event": "pageview", "params": {}}]
+        if random.random() < CLICK_PROBS.get(moon_mars_group, 0):
+            events.append({"ts": ts, "deviceId": device_id, "source": "browser",
+                           "event": "button_click", "params": {"btn_type": moon_mars_group}})
+        async with session.post(f"{BASE_URL}/events/bulk", json=events, cookies=cookies) as resp:
+            await resp.read()
+        return moon_mars_group, white_gold_group
+
+async def run_browser_visits(device_ids):
+    from playwright.async_api import async_playwright
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+        t = [simulate_visit(browser, d) for d in device_ids]
+        results = await asyncio.gather(*t)
+        await browser.close()
+    return results
+
+async def run_http_visits(device_ids, concurrency):
+    sem = asyncio.Semaphore(concurrency)
+    session = await get_session()
+    t = [simulate_http_visit(session, sem, d) for d in device_ids]
+    return await asyncio.gather(*t)
+
+def make_device_ids(seed, start, count):
+    # Visit k of a run gets the uuid with value seed * 2**64 + k,
+    # so workers given disjoint [start, start + count) ranges never share devices.
+    return [str(uuid.UUID(int=(seed << 64) | k)) for k in range(start, start + count)]
+
+def count_groups(results):
+    moon_mars_counts = Counter()
+    white_gold_counts = Counter()
+    for moon_mars_group, white_gold_group in results:
+        moon_mars_counts[moon_mars_group] += 1
+        if white_gold_group is not None:
+            white_gold_counts[white_gold_group] += 1
+    return moon_mars_counts, white_gold_counts
+
+async def run_visits(mode, device_ids, concurrency):
+    if mode == "http":
+        results = await run_http_visits(device_ids, concurrency)
+    else:
+        results = await run_browser_visits(device_ids)
+    return count_groups(results)
+
+def run_worker(mode, seed, start, count, concurrency):
+    async def run():
+        global POOL_SIZE
+        POOL_SIZE = concurrency
+        try:
+            return await run_visits(mode, make_device_ids(seed, start, count), concurrency)
+        finally:
+            await close_session()
+    return asyncio.run(run())
+
+async def run_workers(mode, seed, n, workers, concurrency):
+    loop = asyncio.get_running_loop()
+    shards = [n // workers + (1 if w < n % workers else 0) for w in range(workers)]
+    starts = [sum(shards[:w]) for w in range(workers)]
+    # spawn rather than fork: a forked worker would inherit this process's event loop and session.
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        t = [loop.run_in_executor(pool, run_worker, mode, seed, starts[w], shards[w], concurrency)
+             for w in range(workers) if shards[w]]
+        results = await asyncio.gather(*t)
+    moon_mars_counts, white_gold_counts = Counter(), Counter()
+    for mm, wg in results:
+        moon_mars_counts += mm
+        white_gold_counts += wg
+    return moon_mars_counts, white_gold_counts
+
+SESSION = None
+POOL_SIZE = 100
+RETRIES = 3
+BACKOFF = 0.2
+TIMINGS = defaultdict(list)
+
+async def get_session():
+    global SESSION
+    if SESSION is None or SESSION.closed:
+        connector = aiohttp.TCPConnector(limit=POOL_SIZE, keepalive_timeout=60)
+        SESSION = aiohttp.ClientSession(connector=connector,
+                                        timeout=aiohttp.ClientTimeout(total=None, sock_read=30),
+                                        cookie_jar=aiohttp.DummyCookieJar())
+    return SESSION
+
+async def close_session():
+    global SESSION
+    if SESSION is not None:
+        await SESSION.close()
+        SESSION = None
+
+async def with_retries(name, call):
+    for attempt in range(RETRIES + 1):
+        started = time.perf_counter()
+        try:
+            result = await call(await get_session())
+            TIMINGS[name].append(time.perf_counter() - started)
+            return result
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == RETRIES:
+                raise
+            await asyncio.sleep(BACKOFF * 2 ** attempt)
+
+async def get_json(name, path, **params):
+    async def call(session):
+        async with session.get(f"{BASE_URL}{path}", params=params) as resp:
+            resp.raise_for_status()
+            return await resp.json()
+    return await with_retries(name, call)
+
+async def iter_events(**filters):
+    # Streams events as NDJSON; servers without streaming return a JSON list.
+    # Only opening the response is retried, the stream itself is consumed once.
+    async def call(session):
+        resp = await session.get(f"{BASE_URL}/events", params={"format": "ndjson", **filters})
+        try:
+            resp.raise_for_status()
+        except aiohttp.ClientError:
+            resp.release()
+            raise
+        return resp
+    resp = await with_retries("events (open)", call)
+    started = time.perf_counter()
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=5) as resp:
-                resp.raise_for_status()
-                return await resp.json()
-    except Exception as e:
-        return None
+        if resp.content_type == "application/x-ndjson":
+            async for line in resp.content:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for e in await resp.json():
+                yield e
+    finally:
+        resp.release()
+        TIMINGS["events (stream)"].append(time.perf_counter() - started)
 
 async def fetch_experiments():
-    url = f"{BASE_URL}/api/experiments"
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=5) as resp:
-                resp.raise_for_status()
-                return await resp.json()
+        return await get_json("experiments", "/api/experiments")
     except Exception as e:
         return None
 
+def print_timings():
+    print("HTTP calls:")
+    for name, t in TIMINGS.items():
+        print(f"{name}: {len(t)} calls, {sum(t):.3f}s total, {sum(t) / len(t) * 1000:.1f} ms avg")
+    print("")
+
 def normalized_weights(exp):
     groups = exp.get("groups", {})
     state = exp.get("state")
@@ -84,27 +234,38 @@ def normalized_weights(exp):
     return normalized
 
 async def count_exp_visits_clicks(exp_name):
+    # Single streaming pass: per-device counts are attributed to the device's
+    # last exp_groups group once the stream ends.
     visits, clicks = Counter(), Counter()
-    events = await fetch_events()
-    if events is None:
-        return None, None
     device_groups = {}
-    for e in events:
-        if e.get("event") == "exp_groups":
-            device_groups[e.get("deviceId")] = e["params"].get(exp_name).get('group')
-    for e in events:
-        group = device_groups.get(e.get('deviceId')) or e.get("exp_group")
-        if e.get("event") == "pageview":
-            visits[group] += 1
-        elif e.get("event") == "button_click":
-            clicks[group] += 1
-    return visits, clicks
+    device_counts = defaultdict(Counter)
+    try:
+        async for e in iter_events():
+            name = e.get("event")
+            if name == "exp_groups":
+                device_groups[e.get("deviceId")] = e["params"].get(exp_name).get('group')
+            elif name in ("pageview", "button_click"):
+                device_counts[(e.get("deviceId"), e.get("exp_group"))][name] += 1
+    except Exception as e:
+        return None, None
+    for (device_id, exp_group), counts in device_counts.items():
+        group = device_groups.get(device_id) or exp_group
+        visits[group] += counts["pageview"]
+        clicks[group] += counts["button_click"]
+    return +visits, +clicks
 
 def ctr_ci(v, c):
-    ctr = (c / v) if v > 0 else None
-    ci = 2 * sqrt(ctr * (1 - ctr) / v) if v > 0 else None
+    if v <= 0:
+        return None, None
+    ctr = c / v
+    ci = 2 * sqrt(ctr * (1 - ctr) / v)
     return ctr, ci
 
+def format_conv(ctr, ci):
+    if ctr is None:
+        return "Conv=n/a"
+    return f"Conv={ctr*100:.2f} +- {ci*100:.2f}%"
+
 async def check_split_independence(exp1, exp2):
     exps = await fetch_experiments() or {}
     exp1_weights = normalized_weights(exps.get(exp1, {}))
@@ -115,16 +276,16 @@ async def check_split_independence(exp1, exp2):
     for g1, w1 in exp1_weights.items():
         for g2, w2 in exp2_weights.items():
             expected_split[(g1, g2)] = w1 * w2
-    events = await fetch_events()
-    if events is None:
-        return
     device_groups = {}
-    for e in events:
-        if e.get("event") == "exp_groups":
-            device_groups[e.get("deviceId")] = {
-                exp1: e["params"].get(exp1).get('group'),
-                exp2: e["params"].get(exp2).get('group')
-            }
+    try:
+        async for e in iter_events(event="exp_groups"):
+            if e.get("event") == "exp_groups":
+                device_groups[e.get("deviceId")] = {
+                    exp1: e["params"].get(exp1).get('group'),
+                    exp2: e["params"].get(exp2).get('group')
+                }
+    except Exception as e:
+        return
     split = Counter()
     for d in device_groups.values():
         split[(d[exp1], d[exp2])] += 1
@@ -139,7 +300,33 @@ async def main():
         "-n", "--num-visits", type=int, default=1000,
         help="Number of visits to simulate (default: 1000)"
     )
+    parser.add_argument(
+        "-m", "--mode", choices=["browser", "http"], default="browser",
+        help="browser: Playwright Chromium visits, http: aiohttp requests reproducing the page protocol (default: browser)"
+    )
+    parser.add_argument(
+        "-c", "--concurrency", type=int, default=200,
+        help="Concurrent visits in http mode, per worker (default: 200)"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=1,
+        help="Worker processes, each with its own browser or HTTP session (default: 1)"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=None,
+        help="Seed for device ids; the same seed reproduces the same devices (default: random)"
+    )
     args = parser.parse_args()
+
+    global POOL_SIZE
+    POOL_SIZE = args.concurrency
+    try:
+        await simulate(args)
+    finally:
+        await close_session()
+        print_timings()
+
+async def simulate(args):
     N = args.num_visits
 
     exps = await fetch_experiments() or {}
@@ -148,17 +335,15 @@ async def main():
     if not exps:
         moon_mars_weights = {"Moon": 0.5, "Mars": 0.5}
 
-    moon_mars_counts = Counter()
-    white_gold_counts = Counter()
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
-        t = [simulate_visit(browser) for i in range(N)]
-        results = await asyncio.gather(*t)
-        for moon_mars_group, white_gold_group in results:
-            moon_mars_counts[moon_mars_group] += 1
-            if white_gold_group is not None:
-                white_gold_counts[white_gold_group] += 1
-        await browser.close()
+    seed = args.seed if args.seed is not None else random.getrandbits(64)
+    started = time.perf_counter()
+    if args.workers > 1:
+        moon_mars_counts, white_gold_counts = await run_workers(args.mode, seed, N, args.workers, args.concurrency)
+    else:
+        moon_mars_counts, white_gold_counts = await run_visits(args.mode, make_device_ids(seed, 0, N), args.concurrency)
+    elapsed = time.perf_counter() - started
+    print(f"{N} visits in {elapsed:.2f}s, {N / elapsed:.1f} visits/s, {args.workers} worker(s), seed {seed}")
+    print("")
 
     if moon_mars_counts:
         print("Moon/Mars Exp Split:")
@@ -183,7 +368,7 @@ async def main():
     for group in sorted(visits | clicks):
         v, c = visits[group], clicks[group]
         ctr, ci = ctr_ci(v, c)
-        print(f"{group}: {v} visits, {c} clicks, Conv={ctr*100:.2f} +- {ci*100:.2f}%, Exact: {CLICK_PROBS.get(group)*100:.2f}%")
+        print(f"{group}: {v} visits, {c} clicks, {format_conv(ctr, ci)}, Exact: {CLICK_PROBS.get(group)*100:.2f}%")
     print("")
 
     if white_gold_weights is None:
@@ -195,7 +380,7 @@ async def main():
         v, c = visits[group], clicks[group]
         ctr, ci = ctr_ci(v, c)
         expected_ctr = sum([moon_mars_weights[g] * CLICK_PROBS[g] for g in moon_mars_weights.keys()])
-        print(f"{group}: {v} visits, {c} clicks, Conv={ctr*100:.2f} +- {ci*100:.2f}%, Exact: {expected_ctr*100:.2f}%")
+        print(f"{group}: {v} visits, {c} clicks, {format_conv(ctr, ci)}, Exact: {expected_ctr*100:.2f}%")
     print("")
 
     await check_split_independence("moon_mars", "white_gold_btn")
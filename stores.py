@@ -0,0 +1,241 @@
+import time
+import uuid
+import atexit
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# Measured with tracemalloc on CPython 3.11 for uuid4 device ids:
+# a 144-bit int key, an int value and the OrderedDict entry take about 180 bytes.
+# The (device_id, experiment) -> (group, isoformat) dict it replaces takes about 240
+# plus the 85-byte device_id string each key keeps alive.
+BYTES_PER_ENTRY = 180
+EXP_BITS = 16
+GROUP_BITS = 16
+
+def device_key(device_id: str) -> int:
+    try:
+        return uuid.UUID(device_id).int
+    except (ValueError, AttributeError, TypeError):
+        return int.from_bytes(hashlib.blake2b(str(device_id).encode(), digest_size=16).digest(), 'big')
+
+class StickyStore:
+    # Keys pack the 16-byte device uuid with an interned experiment id,
+    # values pack the epoch-seconds timestamp with a per-experiment group code.
+    # Both ids take 16 bits; interning more experiments or groups raises ValueError.
+    # Least recently used entries are evicted past max_entries,
+    # entries older than ttl seconds are treated as missing.
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, ttl: Optional[int] = None):
+        self.max_entries = max(1, max_bytes // BYTES_PER_ENTRY)
+        self.ttl = ttl
+        self.exp_ids = {}
+        self.group_codes = {}
+        self.group_names = {}
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _exp_id(self, experiment: str) -> int:
+        exp_id = self.exp_ids.get(experiment)
+        if exp_id is None:
+            if len(self.exp_ids) >= 1 << EXP_BITS:
+                raise ValueError(f"StickyStore holds at most {1 << EXP_BITS} experiments")
+            exp_id = self.exp_ids.setdefault(experiment, len(self.exp_ids))
+            self.group_codes[exp_id] = {}
+            self.group_names[exp_id] = []
+        return exp_id
+
+    def _group_code(self, exp_id: int, group: str) -> int:
+        code = self.group_codes[exp_id].get(group)
+        if code is None:
+            code = len(self.group_names[exp_id])
+            if code >= 1 << GROUP_BITS:
+                raise ValueError(f"StickyStore holds at most {1 << GROUP_BITS} groups per experiment")
+            self.group_codes[exp_id][group] = code
+            self.group_names[exp_id].append(group)
+        return code
+
+    def get(self, device_id: str, experiment: str) -> Optional[str]:
+        with self.lock:
+            exp_id = self._exp_id(experiment)
+            key = (device_key(device_id) << EXP_BITS) | exp_id
+            value = self.entries.get(key)
+            if value is None:
+                return None
+            if self.ttl is not None and time.time() - (value >> GROUP_BITS) > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return self.group_names[exp_id][value & ((1 << GROUP_BITS) - 1)]
+
+    def put(self, device_id: str, experiment: str, group: str, ts: Optional[int] = None):
+        with self.lock:
+            exp_id = self._exp_id(experiment)
+            key = (device_key(device_id) << EXP_BITS) | exp_id
+            ts = int(time.time()) if ts is None else ts
+            self.entries[key] = (ts << GROUP_BITS) | self._group_code(exp_id, group)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+class ExposureFilter:
+    # Last logged assignment set per device: keys are device keys, values pack the
+    # epoch-seconds timestamp with a 64-bit digest of the set. An exposure is logged
+    # when the digest changes or window seconds after the last logged one; window <= 0 logs all.
+    # Least recently used devices are evicted past max_entries and simply log again.
+
+    def __init__(self, window: float = 86400, max_bytes: int = 64 * 1024 * 1024):
+        self.window = window
+        self.max_entries = max(1, max_bytes // BYTES_PER_ENTRY)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def should_log(self, device_id: str, digest: int, ts: Optional[int] = None) -> bool:
+        # Only checks; record() once the exposure is accepted, so a dropped event is logged again.
+        if self.window <= 0:
+            return True
+        key = device_key(device_id)
+        ts = int(time.time()) if ts is None else ts
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None and value & 0xFFFFFFFFFFFFFFFF == digest and ts - (value >> 64) < self.window:
+                self.entries.move_to_end(key)
+                return False
+            return True
+
+    def record(self, device_id: str, digest: int, ts: Optional[int] = None):
+        if self.window <= 0:
+            return
+        key = device_key(device_id)
+        ts = int(time.time()) if ts is None else ts
+        with self.lock:
+            self.entries[key] = (ts << 64) | digest
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+class SQLiteStickyStore:
+    # Durable sticky assignments shared by several worker processes.
+    # Reads go through an in-process StickyStore cache, then SQLite.
+    # Writes are buffered and flushed by a background thread in batches;
+    # the first assignment written for a device wins across processes, and a process
+    # whose write lost replaces its cached group with the stored one after the flush.
+
+    def __init__(self, path: str, cache: Optional[StickyStore] = None,
+                 flush_interval: float = 0.5, batch_size: int = 1000):
+        self.path = path
+        self.cache = cache if cache is not None else StickyStore()
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.local = threading.local()
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = False
+        con = self._connection()
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("""CREATE TABLE IF NOT EXISTS assignments (
+                           device BLOB NOT NULL,
+                           experiment TEXT NOT NULL,
+                           grp TEXT NOT NULL,
+                           ts INTEGER NOT NULL,
+                           PRIMARY KEY (device, experiment)
+                       ) WITHOUT ROWID""")
+        con.commit()
+        self.writer = threading.Thread(target=self._flush_loop, daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def _connection(self) -> sqlite3.Connection:
+        con = getattr(self.local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.path, timeout=30)
+            con.execute("PRAGMA synchronous=NORMAL")
+            self.local.con = con
+        return con
+
+    def get(self, device_id: str, experiment: str) -> Optional[str]:
+        gr = self.cache.get(device_id, experiment)
+        if gr is not None:
+            return gr
+        device = device_key(device_id).to_bytes(16, 'big')
+        with self.pending_lock:
+            item = self.pending.get((device, experiment))
+        if item is not None:
+            return item[0]
+        row = self._connection().execute(
+            "SELECT grp, ts FROM assignments WHERE device = ? AND experiment = ?",
+            (device, experiment)).fetchone()
+        if row is None:
+            return None
+        self.cache.put(device_id, experiment, row[0], row[1])
+        return row[0]
+
+    def put(self, device_id: str, experiment: str, group: str, ts: Optional[int] = None):
+        ts = int(time.time()) if ts is None else ts
+        self.cache.put(device_id, experiment, group, ts)
+        device = device_key(device_id).to_bytes(16, 'big')
+        with self.pending_lock:
+            self.pending.setdefault((device, experiment), (group, ts, device_id))
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.wakeup.set()
+
+    def flush(self):
+        with self.pending_lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        con = self._connection()
+        ignored = []
+        with con:
+            for (d, e), (g, ts, device_id) in batch.items():
+                cur = con.execute("INSERT OR IGNORE INTO assignments (device, experiment, grp, ts) VALUES (?, ?, ?, ?)",
+                                  (d, e, g, ts))
+                if cur.rowcount == 0:
+                    ignored.append((d, e, device_id))
+        for d, e, device_id in ignored:
+            row = con.execute("SELECT grp, ts FROM assignments WHERE device = ? AND experiment = ?", (d, e)).fetchone()
+            self.cache.put(device_id, e, row[0], row[1])
+
+    def _flush_loop(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        self.writer.join()
+        self.flush()
+
+    def clear(self):
+        with self.pending_lock:
+            self.pending = {}
+        self.cache.clear()
+        con = self._connection()
+        with con:
+            con.execute("DELETE FROM assignments")
+
+    def __len__(self):
+        self.flush()
+        return self._connection().execute("SELECT COUNT(*) FROM assignments").fetchone()[0]